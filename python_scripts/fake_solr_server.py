@@ -0,0 +1,414 @@
+#!/usr/bin/python
+
+#
+# Local Solr stand-in for benchmarks and offline development
+#
+# Serves an in-memory list of story sentence documents over HTTP with enough of
+# the Solr select API for the word count code: "*:*", field:value and
+# field:[a TO b] clauses joined with AND in q and fq, rows and start, fl,
+# sorting (including random_* fields and cursorMark deep paging),
+# facet.field counts and, through /tvrh, term frequency vectors of the fields
+# that have them in the schema (in the json.nl=map layout).  Responses are written in the JSON format pysolr reads.
+#
+# Run on its own to serve a synthetic corpus (see
+# word_count_benchmark_corpus.py):
+#
+#   fake_solr_server.py --port 8983 --sentences 100000
+#
+# and point pysolr at http://localhost:8983/solr.
+#
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import base64
+import bisect
+import calendar
+import collections
+import json
+import multiprocessing
+import re
+import threading
+import time
+import urlparse
+import zlib
+
+import word_count_benchmark_corpus
+import word_count_days
+
+# fields returned when fl isn't given, as in the schema
+stored_fields = ( 'solr_id', 'story_sentences_id', 'stories_id', 'processed_stories_id', 'sentence', 'title', 'bitly_click_count' )
+
+text_fields = ( 'sentence', 'title' )
+
+# fields with termVectors enabled, and the field each is copied from
+term_vector_fields = { 'sentence_tv': 'sentence' }
+
+date_fields = ( 'publish_date', 'publish_day' )
+
+# number of query results kept sorted for cursor paging
+max_cached_results = 16
+
+_and_re = re.compile( r'\s+AND\s+' )
+
+_clause_re = re.compile( r'^(\w+)\s*:\s*(?:([\[{])\s*(\S+)\s+TO\s+(\S+)\s*([\]}])|(\S+))$' )
+
+_random_sort_re = re.compile( r'^random_(\w+)$' )
+
+# same split as word_count_tokenizer, close enough to the text_general analyzer
+_token_split_re = re.compile( r'[\W\']+', re.UNICODE )
+
+class SolrQueryError( Exception ):
+    pass
+
+def _tokens( text ):
+    return set( _token_split_re.split( text.lower() ) )
+
+def _epoch( date ):
+    return calendar.timegm( date.utctimetuple() ) + date.microsecond / 1e6
+
+def _field_value( field, value ):
+    # Converts a query value to the type of the field's document values
+    if field in date_fields:
+        date = word_count_days.parse_solr_date( value )
+        if date is None:
+            raise SolrQueryError( "unsupported date '{}'".format( value ) )
+        return date
+
+    if field in ( 'stories_id', 'media_id', 'processed_stories_id', 'sentence_number', 'bitly_click_count' ):
+        try:
+            return int( value )
+        except ValueError:
+            raise SolrQueryError( "invalid number '{}' for field {}".format( value, field ) )
+
+    return value.strip( '"' )
+
+def _parse_clause( clause ):
+    # Returns a predicate on documents for a single query clause
+    clause = clause.strip()
+    while clause.startswith( '(' ) and clause.endswith( ')' ):
+        clause = clause[ 1:-1 ].strip()
+
+    if clause in ( '', '*:*', '*' ):
+        return lambda document: True
+
+    match = _clause_re.match( clause )
+    if not match:
+        raise SolrQueryError( "unsupported query clause '{}'".format( clause ) )
+
+    field, start_bracket, start, end, end_bracket, value = match.groups()
+
+    if value is not None:
+        if value == '*':
+            return lambda document: document.get( field ) is not None
+
+        if field in text_fields:
+            term = value.strip( '"' ).lower()
+            return lambda document: term in _tokens( document.get( field ) or u'' )
+
+        value = _field_value( field, value )
+        return lambda document: document.get( field ) == value
+
+    low = _field_value( field, start ) if start != '*' else None
+    high = _field_value( field, end ) if end != '*' else None
+    low_inclusive = start_bracket == '['
+    high_inclusive = end_bracket == ']'
+
+    def in_range( document ):
+        field_value = document.get( field )
+        if field_value is None:
+            return False
+        if low is not None and ( field_value < low or ( field_value == low and not low_inclusive ) ):
+            return False
+        if high is not None and ( field_value > high or ( field_value == high and not high_inclusive ) ):
+            return False
+        return True
+
+    return in_range
+
+def parse_query( query ):
+    # Returns a predicate for AND-ed clauses; other boolean operators aren't
+    # supported
+    predicates = [ _parse_clause( clause ) for clause in _and_re.split( query or '*:*' ) ]
+
+    return lambda document: all( predicate( document ) for predicate in predicates )
+
+def _sort_key_function( sort ):
+    # Returns a function mapping a document to a tuple that sorts in sort order
+    key_functions = []
+
+    for sort_field in sort.split( ',' ):
+        parts = sort_field.split()
+        if len( parts ) != 2 or parts[ 1 ] not in ( 'asc', 'desc' ):
+            raise SolrQueryError( "invalid sort '{}'".format( sort_field ) )
+
+        field, direction = parts
+        sign = 1 if direction == 'asc' else -1
+
+        random_match = _random_sort_re.match( field )
+        if random_match:
+            seed = random_match.group( 1 )
+            key_functions.append( lambda document, seed=seed, sign=sign: sign * zlib.crc32( '{}:{}'.format( seed, document[ 'solr_id' ] ) ) )
+        elif field in date_fields:
+            key_functions.append( lambda document, field=field, sign=sign: sign * _epoch( document[ field ] ) )
+        elif sign == -1:
+            key_functions.append( lambda document, field=field: -document[ field ] )
+        else:
+            key_functions.append( lambda document, field=field: document[ field ] )
+
+    return lambda document: tuple( key_function( document ) for key_function in key_functions )
+
+def _encode_cursor_mark( key ):
+    return base64.b64encode( json.dumps( key ) )
+
+def _decode_cursor_mark( cursor_mark ):
+    try:
+        return tuple( json.loads( base64.b64decode( cursor_mark ) ) )
+    except ( TypeError, ValueError ):
+        raise SolrQueryError( "unable to parse cursorMark '{}'".format( cursor_mark ) )
+
+class FakeSolrIndex( object ):
+
+    def __init__( self, documents ):
+        self.documents = documents
+
+        # ( q, fq, sort ) -> ( sort keys, documents ), most recently used last
+        self._results = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _sorted_results( self, q, fq, sort ):
+        cache_key = ( q, tuple( fq ), sort )
+
+        with self._lock:
+            results = self._results.pop( cache_key, None )
+
+        if results is None:
+            predicates = [ parse_query( q ) ] + [ parse_query( f ) for f in fq ]
+            key_function = _sort_key_function( sort )
+
+            matching = [ ( key_function( document ), document ) for document in self.documents if all( p( document ) for p in predicates ) ]
+            matching.sort( key=lambda key_document: key_document[ 0 ] )
+
+            results = ( [ key for key, document in matching ], [ document for key, document in matching ] )
+
+        with self._lock:
+            self._results[ cache_key ] = results
+            while len( self._results ) > max_cached_results:
+                self._results.popitem( last=False )
+
+        return results
+
+    def select( self, params, term_vectors=False ):
+        q = _single( params, 'q', '*:*' )
+        fq = params.get( 'fq', [] )
+        rows = int( _single( params, 'rows', 10 ) )
+        start = int( _single( params, 'start', 0 ) )
+        sort = _single( params, 'sort', 'solr_id asc' )
+        cursor_mark = _single( params, 'cursorMark' )
+
+        keys, documents = self._sorted_results( q, fq, sort )
+
+        ret = {}
+
+        if cursor_mark is not None:
+            if start:
+                raise SolrQueryError( 'cursorMark and start are mutually exclusive' )
+            if not sort.split( ',' )[ -1 ].split()[ 0 ] == 'solr_id':
+                raise SolrQueryError( 'cursor sort must include the uniqueKey field as a tie breaker' )
+
+            if cursor_mark != '*':
+                start = bisect.bisect_right( keys, _decode_cursor_mark( cursor_mark ) )
+
+            page_end = min( start + rows, len( documents ) )
+            ret[ 'nextCursorMark' ] = _encode_cursor_mark( keys[ page_end - 1 ] ) if page_end > start else cursor_mark
+
+        fields = _field_list( params )
+        page = documents[ start:start + rows ]
+
+        ret[ 'response' ] = {
+            'numFound': len( documents ),
+            'start': start,
+            'docs': [ _stored_document( document, fields ) for document in page ],
+            }
+
+        if term_vectors and _single( params, 'tv' ) == 'true':
+            ret[ 'termVectors' ] = _term_vectors( page, params )
+
+        if _single( params, 'facet' ) == 'true':
+            ret[ 'facet_counts' ] = {
+                'facet_queries': {},
+                'facet_fields': dict( ( field, _facet_counts( documents, field, params ) ) for field in params.get( 'facet.field', [] ) ),
+                'facet_dates': {},
+                'facet_ranges': {},
+                }
+
+        return ret
+
+def _single( params, name, default=None ):
+    values = params.get( name )
+    if not values:
+        return default
+
+    return values[ -1 ]
+
+def _field_list( params ):
+    fields = []
+    for fl in params.get( 'fl', [] ):
+        fields.extend( f for f in re.split( r'[\s,]+', fl ) if f and f != 'score' )
+
+    if not fields or '*' in fields:
+        return stored_fields
+
+    return fields
+
+def _stored_document( document, fields ):
+    return dict( ( field, document[ field ] ) for field in fields if field in document and field in stored_fields )
+
+def _facet_counts( documents, field, params ):
+    # Returns a flat [ value, count, ... ] list, counting documents rather than
+    # occurrences as Solr does
+    limit = int( _single( params, 'facet.limit', 100 ) )
+    mincount = max( int( _single( params, 'facet.mincount', 1 ) ), 1 )
+
+    counts = collections.Counter()
+    for document in documents:
+        value = document.get( field )
+        if value is None:
+            continue
+
+        if field in text_fields:
+            counts.update( _tokens( value ) - set( [ u'' ] ) )
+        else:
+            counts[ value ] += 1
+
+    facet_counts = []
+    for value, count in counts.most_common( limit if limit >= 0 else None ):
+        if count < mincount:
+            break
+        if field in date_fields:
+            value = word_count_days.format_solr_date( value )
+        facet_counts.extend( [ value, count ] )
+
+    return facet_counts
+
+def _term_vectors( documents, params ):
+    term_vectors = { 'uniqueKeyFieldName': 'solr_id' }
+
+    fields = [ field for field in ','.join( params.get( 'tv.fl', [] ) ).split( ',' ) if field ]
+
+    missing_fields = [ field for field in fields if field not in term_vector_fields ]
+    if missing_fields:
+        term_vectors[ 'warnings' ] = { 'noTermVectors': missing_fields }
+
+    for document in documents:
+        vectors = { 'uniqueKey': document[ 'solr_id' ] }
+
+        for field in fields:
+            source = term_vector_fields.get( field )
+            if source is not None and document.get( source ):
+                term_counts = collections.Counter( _token_split_re.split( document[ source ].lower() ) )
+                del term_counts[ u'' ]
+                vectors[ field ] = dict( ( term, { 'tf': count } ) for term, count in term_counts.iteritems() )
+
+        term_vectors[ document[ 'solr_id' ] ] = vectors
+
+    return term_vectors
+
+class FakeSolrRequestHandler( BaseHTTPServer.BaseHTTPRequestHandler ):
+
+    # keep-alive, as pysolr reuses connections
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET( self ):
+        path, query_string = ( self.path.split( '?', 1 ) + [ '' ] )[ :2 ]
+        self._handle( path, query_string )
+
+    def do_POST( self ):
+        length = int( self.headers.getheader( 'content-length' ) or 0 )
+        body = self.rfile.read( length )
+        path, query_string = ( self.path.split( '?', 1 ) + [ '' ] )[ :2 ]
+        self._handle( path, '&'.join( filter( None, [ query_string, body ] ) ) )
+
+    def _handle( self, path, query_string ):
+        start_time = time.time()
+
+        handler = [ part for part in path.split( '/' ) if part ][ -1: ]
+
+        params = urlparse.parse_qs( query_string, keep_blank_values=True )
+        params = dict( ( name, [ value.decode( 'utf-8' ) for value in values ] ) for name, values in params.iteritems() )
+
+        if handler not in ( [ 'select' ], [ 'tvrh' ] ):
+            return self._send( 404, { 'error': { 'msg': "no handler for '{}'".format( path ), 'code': 404 } }, start_time )
+
+        try:
+            ret = self.server.index.select( params, term_vectors=handler == [ 'tvrh' ] )
+        except ( SolrQueryError, ValueError ), e:
+            return self._send( 400, { 'error': { 'msg': str( e ), 'code': 400 } }, start_time )
+
+        self._send( 200, ret, start_time )
+
+    def _send( self, status, ret, start_time ):
+        ret[ 'responseHeader' ] = { 'status': 0 if status == 200 else status, 'QTime': int( ( time.time() - start_time ) * 1000 ) }
+
+        body = json.dumps( ret )
+
+        self.send_response( status )
+        self.send_header( 'Content-Type', 'application/json; charset=UTF-8' )
+        self.send_header( 'Content-Length', str( len( body ) ) )
+        self.end_headers()
+        self.wfile.write( body )
+
+    def log_message( self, format, *args ):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message( self, format, *args )
+
+class FakeSolrServer( SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer ):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__( self, index, host='127.0.0.1', port=0, verbose=False ):
+        BaseHTTPServer.HTTPServer.__init__( self, ( host, port ), FakeSolrRequestHandler )
+        self.index = index
+        self.verbose = verbose
+
+    @property
+    def url( self ):
+        host, port = self.server_address
+        return 'http://{}:{}/solr'.format( host, port )
+
+def start_in_process( documents, host='127.0.0.1', port=0 ):
+    # Serves documents from a child process, so that the server doesn't compete
+    # with the caller for the GIL; returns ( process, url ).  Stop the server
+    # with process.terminate().
+    server = FakeSolrServer( FakeSolrIndex( documents ), host, port )
+
+    process = multiprocessing.Process( target=server.serve_forever )
+    process.daemon = True
+    process.start()
+
+    url = server.url
+    server.server_close()
+
+    return process, url
+
+def main():
+    parser = argparse.ArgumentParser( description='Serve a synthetic story sentence corpus with a local Solr stand-in' )
+    parser.add_argument( '--host', default='127.0.0.1' )
+    parser.add_argument( '--port', type=int, default=8983 )
+    parser.add_argument( '--sentences', type=int, default=100000 )
+    parser.add_argument( '--vocabulary-size', type=int, default=50000 )
+    parser.add_argument( '--seed', type=int, default=0 )
+    parser.add_argument( '--verbose', action='store_true' )
+    args = parser.parse_args()
+
+    documents = word_count_benchmark_corpus.generate_documents( args.sentences, args.vocabulary_size, args.seed )
+
+    server = FakeSolrServer( FakeSolrIndex( documents ), args.host, args.port, args.verbose )
+
+    print "serving {} sentences at {}".format( len( documents ), server.url )
+
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
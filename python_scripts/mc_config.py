@@ -42,3 +42,49 @@ def read_config():
 
     return config_file
 
+
+_config = None
+
+def get_config():
+    # Merged configuration, read once per process
+    global _config
+
+    if _config is None:
+        _config = read_config()
+
+    return _config
+
+def set_config( config ):
+    # Overrides the configuration returned by get_config() and the sections
+    # derived from it, for tools (e.g. benchmarks) that must not depend on the
+    # local mediawords.yml
+    global _config, _word_count_config, _solr_client_config
+
+    _config = config
+    _word_count_config = None
+    _solr_client_config = None
+
+_word_count_config = None
+
+def word_count_config():
+    # "word_count" section of the configuration
+    global _word_count_config
+
+    if _word_count_config is None:
+        _word_count_config = get_config().get( 'word_count' ) or {}
+
+    return _word_count_config
+
+_solr_client_config = None
+
+def solr_client_config():
+    # "solr_client" section of the configuration
+    global _solr_client_config
+
+    if _solr_client_config is None:
+        _solr_client_config = get_config().get( 'solr_client' ) or {}
+
+    return _solr_client_config
+
+def read_defaults_config():
+    return _load_yml( _defaults_config_file_name )
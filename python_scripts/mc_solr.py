@@ -1,19 +1,470 @@
 import requests
+import requests.adapters
 import mc_config
 import psycopg2
 import psycopg2.extras
+import random
+import threading
 import time
 import json
 import pysolr
 import sys
+import urlparse
+
+import word_count_deadline
+
+# Requests to these handlers may be answered by any configured Solr URL;
+# anything else (updates, dataimport commands and status) goes to the URL the
+# caller asked for
+balanced_handlers = ( 'select', 'tvrh', 'query' )
+
+# Weight of the latest request in an endpoint's moving average latency
+latency_decay = 0.2
+
+class SolrEndpoint( object ):
+
+    def __init__( self, url ):
+        self.url = url.rstrip( '/' )
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency = None
+        self.ejected_until = None
+        self.eject_seconds = None
+        self.probing = False
+
+    def stats( self ):
+        return {
+            'url': self.url,
+            'outstanding': self.outstanding,
+            'requests': self.requests,
+            'failures': self.failures,
+            'latency': self.latency,
+            'ejected': self.ejected_until is not None,
+            }
+
+class SolrEndpoints( object ):
+    # Spreads requests over every configured Solr URL, either round robin or
+    # to the endpoint with the fewest outstanding requests.  An endpoint that
+    # failed eject_after_failures requests in a row is taken out of rotation
+    # for eject_seconds; after that a single request probes it and either
+    # brings it back or ejects it again for twice as long (up to
+    # max_eject_seconds).
+
+    def __init__( self, urls, balance='least_outstanding', eject_after_failures=3, eject_seconds=30, max_eject_seconds=300 ):
+        if balance not in ( 'least_outstanding', 'round_robin' ):
+            raise Exception( "unknown Solr balancing method '{0}'".format( balance ) )
+
+        self.endpoints = [ SolrEndpoint( url ) for url in urls ]
+        self.balance = balance
+        self.eject_after_failures = eject_after_failures
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def match( self, url ):
+        # Returns the endpoint url belongs to and the rest of url, or None
+        for endpoint in self.endpoints:
+            if url.startswith( endpoint.url + '/' ):
+                return endpoint, url[ len( endpoint.url ): ]
+
+        return None
+
+    def _available( self, endpoint, now ):
+        return endpoint.ejected_until is None or ( endpoint.ejected_until <= now and not endpoint.probing )
+
+    def acquire( self, exclude=(), endpoint=None ):
+        # Picks an endpoint for a request (or takes the given one); call
+        # release() once the request is done
+        with self._lock:
+            if endpoint is not None:
+                endpoint.outstanding += 1
+                return endpoint
+
+            now = time.time()
+
+            candidates = [ e for e in self.endpoints if e not in exclude and self._available( e, now ) ]
+            if not candidates:
+                # every endpoint is down; try the one that comes back first
+                candidates = sorted( [ e for e in self.endpoints if e not in exclude ] or self.endpoints, key=lambda e: e.ejected_until )[ :1 ]
+
+            # rotate the starting point so that ties are spread evenly
+            self._next = ( self._next + 1 ) % len( candidates )
+            candidates = candidates[ self._next: ] + candidates[ :self._next ]
+
+            if self.balance == 'least_outstanding':
+                endpoint = min( candidates, key=lambda e: e.outstanding )
+            else:
+                endpoint = candidates[ 0 ]
+
+            if endpoint.ejected_until is not None:
+                endpoint.probing = True
+
+            endpoint.outstanding += 1
+
+            return endpoint
+
+    def release( self, endpoint, seconds, ok ):
+        with self._lock:
+            endpoint.outstanding -= 1
+            endpoint.requests += 1
+
+            if ok:
+                if endpoint.ejected_until is not None:
+                    sys.stderr.write( 'Solr endpoint {0} is back\n'.format( endpoint.url ) )
+
+                endpoint.latency = seconds if endpoint.latency is None else ( 1 - latency_decay ) * endpoint.latency + latency_decay * seconds
+                endpoint.consecutive_failures = 0
+                endpoint.ejected_until = None
+                endpoint.eject_seconds = None
+                endpoint.probing = False
+                return
+
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+
+            if endpoint.probing or endpoint.consecutive_failures >= self.eject_after_failures:
+                if endpoint.eject_seconds is None:
+                    endpoint.eject_seconds = self.eject_seconds
+                elif endpoint.probing:
+                    endpoint.eject_seconds = min( endpoint.eject_seconds * 2, self.max_eject_seconds )
+
+                endpoint.ejected_until = time.time() + endpoint.eject_seconds
+                endpoint.probing = False
+
+                sys.stderr.write( 'ejecting Solr endpoint {0} for {1}s\n'.format( endpoint.url, endpoint.eject_seconds ) )
+
+    def stats( self ):
+        with self._lock:
+            return [ endpoint.stats() for endpoint in self.endpoints ]
+
+def _parse_path( path, body=None ):
+    # Returns the parts of the path and the parameters of the query string and
+    # form encoded body
+    path, _, query_string = path.partition( '?' )
+    parts = [ part for part in path.split( '/' ) if part ]
+
+    params = urlparse.parse_qs( query_string )
+    if isinstance( body, basestring ):
+        params.update( urlparse.parse_qs( body ) )
+
+    return parts, params
+
+def _is_balanced( path, body=None ):
+    # path is the part of the URL after the Solr base URL, e.g.
+    # "/collection1/select/?q=..."
+    parts, params = _parse_path( path, body )
+
+    if not parts or parts[ -1 ] not in balanced_handlers:
+        return False
+
+    # a non-distributed search (mc_solr_shards.py) only asks the core it is
+    # sent to for its own documents, so it has to reach that core
+    return 'false' not in params.get( 'distrib', [] )
+
+def _is_retryable( method, url, body=None ):
+    # Searches and status requests (dataimport status, admin status and
+    # listings) only read, so they may be retried; updates and dataimport
+    # commands may have been carried out before the connection failed or Solr
+    # answered with an error, and are never sent twice
+    url = urlparse.urlsplit( url )
+    parts, params = _parse_path( url.path + '?' + url.query, body )
+
+    if not parts:
+        return False
+
+    if parts[ -1 ] in balanced_handlers:
+        return True
+
+    if method != 'GET':
+        return False
+
+    if parts[ -1 ] == 'dataimport':
+        return params.get( 'command', [ 'status' ] ) == [ 'status' ]
+
+    if 'admin' in parts:
+        return params.get( 'action', [ 'STATUS' ] )[ 0 ].upper() in ( 'STATUS', 'LIST', 'CLUSTERSTATUS' )
+
+    return False
+
+class _RetryingHTTPAdapter( requests.adapters.HTTPAdapter ):
+    # Connection pooling adapter that applies a default timeout and retries
+    # searches and status requests (see _is_retryable()) that fail to connect
+    # or get a 5xx response, waiting retry_backoff * 2 ** attempt seconds (plus
+    # jitter) between attempts.  A retry that the request deadline
+    # (word_count_deadline.py) can't wait for isn't made.
+    #
+    # Requests to a configured Solr URL are timed per endpoint, and search
+    # requests are sent to the endpoint picked by endpoints; a failed search is
+    # retried on another endpoint right away when one is left.
+
+    def __init__( self, pool_size, timeout, retries, retry_backoff, endpoints ):
+        requests.adapters.HTTPAdapter.__init__( self, pool_connections=pool_size, pool_maxsize=pool_size )
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.endpoints = endpoints
+
+    def send( self, request, **kwargs ):
+        if kwargs.get( 'timeout' ) is None:
+            kwargs[ 'timeout' ] = self.timeout
+
+        match = self.endpoints.match( request.url )
+        balanced = match is not None and _is_balanced( match[ 1 ], request.body )
+        retries = self.retries if _is_retryable( request.method, request.url, request.body ) else 0
+
+        tried = []
+        attempt = 0
+        while True:
+            endpoint = None
+            if balanced:
+                endpoint = self.endpoints.acquire( exclude=tried )
+                tried.append( endpoint )
+                request = request.copy()
+                request.url = endpoint.url + match[ 1 ]
+            elif match is not None:
+                endpoint = self.endpoints.acquire( endpoint=match[ 0 ] )
+
+            start_time = time.time()
+            try:
+                response = requests.adapters.HTTPAdapter.send( self, request, **kwargs )
+            except Exception, e:
+                if endpoint is not None:
+                    self.endpoints.release( endpoint, time.time() - start_time, False )
+                if not isinstance( e, requests.exceptions.ConnectionError ) or attempt >= retries:
+                    raise
+                error = str( e )
+            else:
+                ok = response.status_code < 500
+                if endpoint is not None:
+                    self.endpoints.release( endpoint, time.time() - start_time, ok )
+                if ok or attempt >= retries:
+                    return response
+                error = 'HTTP {0}'.format( response.status_code )
+                response.close()
+
+            attempt += 1
+
+            # fail over to an endpoint this request hasn't tried yet without waiting
+            if balanced and len( tried ) < len( self.endpoints.endpoints ):
+                sys.stderr.write( 'retrying {0} {1} on another endpoint ({2}; retry {3} of {4})\n'.format( request.method, request.url, error, attempt, retries ) )
+                continue
+
+            delay = self.retry_backoff * ( 2 ** ( attempt - 1 ) ) * ( 1 + random.random() )
+
+            # no point in waiting for a retry whose answer would come too late
+            remaining = word_count_deadline.remaining()
+            if remaining is not None and delay >= remaining:
+                raise word_count_deadline.DeadlineExceeded( 'request deadline exceeded' )
+
+            sys.stderr.write( 'retrying {0} {1} in {2:.1f}s ({3}; retry {4} of {5})\n'.format( request.method, request.url, delay, error, attempt, retries ) )
+            time.sleep( delay )
+
+            tried = []
+
+_session = None
+_endpoints = None
+_session_lock = threading.Lock()
+
+def get_session():
+    # Keep-alive HTTP session shared by every Solr request of the process,
+    # configured by the "solr_client" section of the configuration and
+    # balancing searches over every mediawords.solr_url
+    global _session, _endpoints
+
+    with _session_lock:
+        if _session is None:
+            config = mc_config.solr_client_config()
+
+            endpoints = SolrEndpoints(
+                mc_config.get_config()[ 'mediawords' ].get( 'solr_url' ) or [],
+                balance=config.get( 'balance' ) or 'least_outstanding',
+                eject_after_failures=int( config.get( 'eject_after_failures' ) or 3 ),
+                eject_seconds=float( config.get( 'eject_seconds' ) or 30 ),
+                max_eject_seconds=float( config.get( 'max_eject_seconds' ) or 300 ) )
+
+            adapter = _RetryingHTTPAdapter(
+                pool_size=int( config.get( 'pool_size' ) or 10 ),
+                timeout=float( config.get( 'timeout' ) or 300 ),
+                retries=int( config.get( 'retries' ) or 0 ),
+                retry_backoff=float( config.get( 'retry_backoff' ) or 0 ),
+                endpoints=endpoints )
+
+            session = requests.Session()
+            session.mount( 'http://', adapter )
+            session.mount( 'https://', adapter )
+            session.headers.update( { 'Accept': 'application/json', 'Accept-Encoding': 'gzip' } )
+
+            _session = session
+            _endpoints = endpoints
+
+        return _session
+
+def endpoint_stats():
+    # Request counts, failures, outstanding requests and moving average
+    # latency of every configured Solr URL
+    get_session()
+    return _endpoints.stats()
+
+def py_solr_connection( url=None ):
+    # pysolr connection whose requests go through the shared session
+    if url is None:
+        url = get_solr_collection_url_prefix()
+
+    solr = pysolr.Solr( url, timeout=float( mc_config.solr_client_config().get( 'timeout' ) or 300 ) )
+    solr.session = get_session()
 
-def py_solr_connection():
-    solr = pysolr.Solr(get_solr_collection_url_prefix(), timeout=300)
-    
     return solr
 
+# Number of documents requested per page by fetch_all_pages()
+fetch_page_size = 10000
+
+def fetch_all_pages( solr, query, fq=None, fields=None, num_matching_documents=None, rows=None, sort=None, params=None ):
+    # Pages through every document matching the query using a Solr cursor
+    # (sorted on the solr_id uniqueKey) and yields one page of documents at a
+    # time, so that only a single page of the result set is ever held in memory.
+    #
+    # Pass num_matching_documents if the caller already knows the hit count to
+    # avoid issuing another count query; passing a smaller number stops the
+    # fetch after that many documents.  A custom sort must end with the solr_id
+    # tie breaker that cursors require.  params are sent with every request.
+    if rows is None:
+        rows = fetch_page_size
+    if sort is None:
+        sort = 'solr_id asc'
+
+    base_params = dict( params or {} )
+    if fq is not None:
+        base_params['fq'] = fq
+    if fields is not None:
+        base_params['fl'] = fields
+
+    if num_matching_documents is None:
+        num_matching_documents = solr.search( query, **dict( base_params, rows=0 ) ).hits
+
+    sys.stderr.write( u'starting cursor fetch of {0} documents for {1}\n'.format( num_matching_documents, query ).encode( 'utf-8' ) )
+
+    for results in _cursor_pages( solr.search, query, base_params, num_matching_documents, rows, sort ):
+        yield results.docs
+
+def _cursor_pages( search, query, base_params, num_matching_documents, rows, sort ):
+    # Yields the results of every cursor page of the query, as returned by
+    # search( query, **params )
+    fetched = 0
+    cursor_mark = '*'
+    while fetched < num_matching_documents:
+        params = dict( base_params )
+        params.update( {
+                'rows': min( rows, num_matching_documents - fetched ),
+                'sort': sort,
+                'cursorMark': cursor_mark,
+                } )
+        results = search( query, **params )
+
+        if not results.docs:
+            break
+
+        fetched += len( results.docs )
+        yield results
+
+        # Solr returns the same cursor mark once the result set is exhausted
+        if results.nextCursorMark == cursor_mark:
+            break
+        cursor_mark = results.nextCursorMark
+
+def search_handler( solr, handler, query, **params ):
+    # Like solr.search(), but sends the query to another search handler (e.g.
+    # "tvrh") and returns the whole decoded response, including the sections
+    # that pysolr's Results drop
+    params = dict( params, q=query, wt='json' )
+    params_encoded = pysolr.safe_urlencode( params, True )
+
+    if len( params_encoded ) < 1024:
+        response = solr._send_request( 'get', '{0}/?{1}'.format( handler, params_encoded ) )
+    else:
+        response = solr._send_request( 'post', handler + '/', body=params_encoded,
+                                       headers={ 'Content-type': 'application/x-www-form-urlencoded; charset=utf-8' } )
+
+    return solr.decoder.decode( response )
+
+class MissingTermVectors( Exception ):
+    pass
+
+def fetch_all_term_vector_pages( solr, query, field, fq=None, num_matching_documents=None, rows=None, sort=None, params=None ):
+    # Pages through every document matching the query like fetch_all_pages(),
+    # but through the /tvrh handler: yields, for each page, a list with one
+    # { term: term frequency } dict per document holding the terms Solr indexed
+    # for field.  Stored fields aren't transferred.  Raises MissingTermVectors
+    # if field has no term vectors (not enabled in the schema, or documents
+    # indexed before they were), rather than counting nothing.
+    if rows is None:
+        rows = fetch_page_size
+    if sort is None:
+        sort = 'solr_id asc'
+
+    base_params = dict( params or {} )
+    base_params.update( {
+        'fl': 'solr_id',
+        'tv': 'true',
+        'tv.fl': field,
+        'tv.tf': 'true',
+        'tv.df': 'false',
+        'tv.positions': 'false',
+        'tv.offsets': 'false',
+        'tv.payloads': 'false',
+        'json.nl': 'map',
+        } )
+    count_params = dict( params or {}, rows=0 )
+    if fq is not None:
+        base_params['fq'] = count_params['fq'] = fq
+
+    if num_matching_documents is None:
+        num_matching_documents = solr.search( query, **count_params ).hits
+
+    sys.stderr.write( u'starting term vector fetch of {0} documents for {1}\n'.format( num_matching_documents, query ).encode( 'utf-8' ) )
+
+    def search( query, **params ):
+        response = search_handler( solr, 'tvrh', query, **params )
+
+        results = pysolr.Results( response[ 'response' ][ 'docs' ], response[ 'response' ][ 'numFound' ], nextCursorMark=response.get( 'nextCursorMark' ) )
+        results.term_vectors = response.get( 'termVectors' ) or {}
+
+        return results
+
+    for results in _cursor_pages( search, query, base_params, num_matching_documents, rows, sort ):
+        # termVectors maps each document's unique key to its vectors; it also
+        # holds a "uniqueKeyFieldName" string entry and, if some fields have no
+        # term vectors, a "warnings" entry listing them
+        warnings = results.term_vectors.get( 'warnings' ) or {}
+        if field in ( warnings.get( 'noTermVectors' ) or [] ):
+            raise MissingTermVectors( "field '{0}' has no term vectors".format( field ) )
+
+        documents = [ vectors for key, vectors in results.term_vectors.iteritems() if key != 'warnings' and isinstance( vectors, dict ) ]
+
+        # a document without any term in field has no vectors either, but not
+        # a whole page of them
+        if results.docs and not any( field in vectors for vectors in documents ):
+            raise MissingTermVectors( "no term vectors for field '{0}' in {1} documents".format( field, len( results.docs ) ) )
+
+        yield [ _term_frequencies( vectors.get( field ) ) for vectors in documents ]
+
+def _term_frequencies( field_vectors ):
+    if not field_vectors:
+        return {}
+
+    return dict( ( term, info[ 'tf' ] ) for term, info in field_vectors.iteritems() )
+
+def fetch_all( solr, query, fq=None, fields=None, num_matching_documents=None, rows=None, sort=None ):
+    # Document-at-a-time view of fetch_all_pages()
+    for page in fetch_all_pages( solr, query, fq, fields, num_matching_documents, rows, sort ):
+        for document in page:
+            yield document
+
 def get_solr_collection_url_prefix():
-    config = mc_config.read_config()
+    config = mc_config.get_config()
 
     #print >> sys.stderr, config
 
@@ -21,36 +472,26 @@ def get_solr_collection_url_prefix():
 
     return solr_collection_url
 
-def solr_request( path, params):
-    url = get_solr_collection_url_prefix() + '/' + path
-    print 'url: {}'.format( url )
-    params['wt'] = 'json'
-    r = requests.get( url, params=params, headers = { 'Accept': 'application/json'}) 
-    print 'request url '
-    print r.url
-
-    data = r.json()
+def solr_request( path, params ):
+    params = dict( params, wt='json' )
 
-    return data
+    r = get_session().get( get_solr_collection_url_prefix() + '/' + path, params=params )
 
-def _solr_post( path, params, payload):
-    url = get_solr_collection_url_prefix() + '/' + path
-    print 'url: {}'.format( url )
+    return r.json()
 
-    r = requests.post( url, data=json.dumps(payload), params=params, headers = { 'Accept': 'application/json', 'Content-type': 'application/json; charset=utf-8' } )
-    print 'request url '
-    print r.url
+def _solr_post( path, params, payload ):
+    params = dict( params, wt='json' )
 
-    data = r.json()
+    r = get_session().post( get_solr_collection_url_prefix() + '/' + path, data=json.dumps( payload ), params=params,
+                            headers={ 'Content-type': 'application/json; charset=utf-8' } )
 
-    return data
+    return r.json()
 
 def delete_all_documents():
-    _solr_post( 'update', { 'commit': 'true'}, {'delete': {'query': '*:*'}} )
+    return _solr_post( 'update', { 'commit': 'true'}, {'delete': {'query': '*:*'}} )
 
-def dataimport_command( command, params={}):
-    params['command'] = command
-    return solr_request( 'dataimport', params )
+def dataimport_command( command, params={} ):
+    return solr_request( 'dataimport', dict( params, command=command ) )
 
 def dataimport_status():
     return dataimport_command( 'status' )
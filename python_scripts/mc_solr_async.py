@@ -0,0 +1,73 @@
+#!/usr/bin/python
+
+#
+# Asynchronous Solr requests for callers that overlap many round trips
+#
+# Python 2 has no asyncio, so requests are run on a shared, bounded pool of
+# I/O threads instead of an event loop: submit() returns at once with an
+# AsyncResult (the same kind of handle word_count_pool hands out) and at most
+# max_concurrency requests are in flight per process, however many callers
+# submit them.  Requests go through mc_solr's shared keep-alive session, so
+# they are balanced and retried like any other Solr request.
+#
+# fetch_all_pages() is a drop-in replacement for mc_solr.fetch_all_pages()
+# that requests the next cursor page while the caller is still working on the
+# current one, by running mc_solr's own cursor fetch one page ahead with
+# prefetch().
+#
+# Don't wait for an AsyncResult from inside a task running on this pool; the
+# pool's threads could all end up waiting for tasks queued behind them.
+#
+# prefetch() stops waiting with word_count_deadline.DeadlineExceeded once the
+# caller's request deadline passed.
+#
+
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+import mc_config
+import mc_solr
+import word_count_deadline
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            config = mc_config.solr_client_config()
+
+            max_concurrency = int( config.get( 'max_concurrency' ) or 0 ) or int( config.get( 'pool_size' ) or 10 )
+
+            _pool = ThreadPool( max_concurrency )
+
+        return _pool
+
+def submit( function, *args, **kwargs ):
+    return get_pool().apply_async( function, args, kwargs )
+
+def prefetch( iterator ):
+    # Yields the items of iterator, computing each next one on the pool while
+    # the caller is still working on the current one, so at most two items are
+    # held.  iterator is only ever advanced by one thread at a time.
+    done = object()
+
+    pending = submit( next, iterator, done )
+
+    while True:
+        item = word_count_deadline.wait( pending )
+        if item is done:
+            return
+
+        pending = submit( next, iterator, done )
+
+        yield item
+
+def fetch_all_pages( solr, query, fq=None, fields=None, num_matching_documents=None, rows=None, sort=None ):
+    # Same pages as mc_solr.fetch_all_pages(), but the request for each page is
+    # sent as soon as the previous one has arrived, so fetching overlaps with
+    # whatever the caller does with a page
+    return prefetch( mc_solr.fetch_all_pages( solr, query, fq, fields, num_matching_documents, rows, sort ) )
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+
+#
+# Shard-direct fetching from a SolrCloud cluster
+#
+# A distributed search makes the node it is sent to gather every page from all
+# shards and serialize it once more, so bulk reads through it are capped by a
+# single node.  fetch_all_pages() instead asks every shard core for its own
+# documents (distrib=false), walks each shard with its own cursor on its own
+# thread and yields pages as they arrive from any shard, so bulk reads grow
+# with the number of shards.
+#
+# Pages come in no particular order; use this only for callers that need every
+# matching document and don't care about their order, like word counts.
+#
+# The shard layout is, in order of preference:
+#
+#   * solr_client.shard_urls, one core URL per shard
+#   * the cluster state SolrCloud keeps in ZooKeeper, as returned by the
+#     Collections API CLUSTERSTATUS action: one active replica per shard,
+#     preferring the leader
+#   * the shard port scheme of solr/mc_solr (shard n listens on
+#     cluster_starting_port + n - 1), if the first solr_url is on one of the
+#     shard ports
+#
+# and is looked up again every shard_layout_ttl seconds.  A standalone Solr has
+# no layout, and callers fall back to mc_solr.fetch_all_pages().
+#
+
+import Queue
+import sys
+import threading
+import time
+import urlparse
+
+import mc_config
+import mc_solr
+import word_count_deadline
+
+# MC_SOLR_CLUSTER_STARTING_PORT in solr/mc_solr/constants.py
+cluster_starting_port = 7981
+
+collection_name = 'collection1'
+
+_layout = None
+_layout_time = None
+_layout_lock = threading.Lock()
+
+def enabled():
+    return str( mc_config.solr_client_config().get( 'shard_fetch' ) or 'no' ).lower() in ( 'yes', 'true', '1' )
+
+def _cluster_status_shard_urls( solr_url ):
+    response = mc_solr.get_session().get( solr_url + '/admin/collections',
+                                          params={ 'action': 'CLUSTERSTATUS', 'collection': collection_name, 'wt': 'json' } )
+    if response.status_code != 200:
+        # e.g. "Solr instance is not running in SolrCloud mode"
+        return None
+
+    shards = response.json()[ 'cluster' ][ 'collections' ][ collection_name ][ 'shards' ]
+
+    shard_urls = []
+    for shard_name in sorted( shards.keys() ):
+        shard = shards[ shard_name ]
+        if shard.get( 'state', 'active' ) != 'active':
+            continue
+
+        replicas = [ replica for replica in shard[ 'replicas' ].itervalues() if replica.get( 'state' ) == 'active' ]
+        if not replicas:
+            raise Exception( "no active replica of shard {0}".format( shard_name ) )
+
+        replica = sorted( replicas, key=lambda replica: replica.get( 'leader' ) != 'true' )[ 0 ]
+
+        shard_urls.append( replica[ 'base_url' ].rstrip( '/' ) + '/' + replica[ 'core' ] )
+
+    return shard_urls
+
+def _port_scheme_shard_urls( solr_url ):
+    url = urlparse.urlparse( solr_url )
+
+    shard_count = int( mc_config.get_config()[ 'supervisor_solr' ][ 'cluster' ][ 'shards' ][ 'cluster_shard_count' ] )
+
+    if url.port is None or not cluster_starting_port <= url.port < cluster_starting_port + shard_count:
+        return None
+
+    return [ '{0}://{1}:{2}{3}/{4}'.format( url.scheme, url.hostname, cluster_starting_port + shard, url.path.rstrip( '/' ), collection_name )
+             for shard in range( shard_count ) ]
+
+def discover_shard_urls():
+    # Returns the core URL of every shard, or None if Solr isn't sharded
+    config = mc_config.solr_client_config()
+
+    if config.get( 'shard_urls' ):
+        return [ url.rstrip( '/' ) for url in config[ 'shard_urls' ] ]
+
+    solr_urls = mc_config.get_config()[ 'mediawords' ].get( 'solr_url' ) or []
+    if not solr_urls:
+        return None
+
+    solr_url = solr_urls[ 0 ].rstrip( '/' )
+
+    try:
+        shard_urls = _cluster_status_shard_urls( solr_url )
+    except Exception, e:
+        sys.stderr.write( 'unable to read the Solr cluster state from {0}: {1}\n'.format( solr_url, e ) )
+        shard_urls = None
+
+    if shard_urls is None:
+        shard_urls = _port_scheme_shard_urls( solr_url )
+
+    return shard_urls
+
+def shard_urls():
+    # discover_shard_urls(), looked up at most once every shard_layout_ttl seconds
+    global _layout, _layout_time
+
+    ttl = float( mc_config.solr_client_config().get( 'shard_layout_ttl' ) or 60 )
+
+    with _layout_lock:
+        if _layout_time is None or time.time() - _layout_time > ttl:
+            _layout = discover_shard_urls()
+            _layout_time = time.time()
+
+            if _layout:
+                sys.stderr.write( 'Solr shards: {0}\n'.format( ', '.join( _layout ) ) )
+
+        return _layout
+
+def _merge_shard_pages( urls, shard_pages ):
+    # Runs shard_pages( solr ) for every shard URL on its own thread and yields
+    # the pages of all of them as they arrive.  At most two pages per shard are
+    # waiting to be consumed; the first error of any shard is raised here.
+    pages = Queue.Queue( maxsize=2 * len( urls ) )
+    stop = threading.Event()
+
+    def put( item ):
+        while not stop.is_set():
+            try:
+                pages.put( item, timeout=1 )
+                return
+            except Queue.Full:
+                pass
+
+    def fetch_shard( url ):
+        try:
+            for page in shard_pages( mc_solr.py_solr_connection( url ) ):
+                if stop.is_set():
+                    return
+                put( ( 'page', page ) )
+        except Exception, e:
+            put( ( 'error', ( url, e, sys.exc_info()[ 2 ] ) ) )
+        finally:
+            put( ( 'done', url ) )
+
+    threads = [ threading.Thread( target=fetch_shard, args=( url, ), name='shard fetch ' + url ) for url in urls ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        remaining = len( threads )
+        while remaining:
+            try:
+                kind, value = pages.get( timeout=word_count_deadline.remaining() )
+            except Queue.Empty:
+                raise word_count_deadline.DeadlineExceeded( 'request deadline exceeded' )
+
+            if kind == 'page':
+                yield value
+            elif kind == 'done':
+                remaining -= 1
+            else:
+                url, e, traceback = value
+                sys.stderr.write( 'fetch from Solr shard {0} failed: {1}\n'.format( url, e ) )
+                raise type( e ), e, traceback
+    finally:
+        # also stops the other shards when the caller gives up early
+        stop.set()
+
+def fetch_all_pages( query, fq=None, fields=None, rows=None, urls=None ):
+    # Every document matching the query, a page at a time, like
+    # mc_solr.fetch_all_pages() but from all shards at once
+    if urls is None:
+        urls = shard_urls()
+
+    sys.stderr.write( u'starting shard-direct fetch for {0} from {1} shards\n'.format( query, len( urls ) ).encode( 'utf-8' ) )
+
+    return _merge_shard_pages( urls, lambda solr: mc_solr.fetch_all_pages( solr, query, fq, fields, rows=rows, params={ 'distrib': 'false' } ) )
+
+def fetch_all_term_vector_pages( query, field, fq=None, rows=None, urls=None ):
+    # Like mc_solr.fetch_all_term_vector_pages(), but from all shards at once
+    if urls is None:
+        urls = shard_urls()
+
+    sys.stderr.write( u'starting shard-direct term vector fetch for {0} from {1} shards\n'.format( query, len( urls ) ).encode( 'utf-8' ) )
+
+    return _merge_shard_pages( urls, lambda solr: mc_solr.fetch_all_term_vector_pages( solr, query, field, fq, rows=rows, params={ 'distrib': 'false' } ) )
@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import time
+import uuid
 
 import ipdb
 #import time
@@ -21,35 +22,19 @@ from nltk.tokenize import RegexpTokenizer
 from joblib import Parallel, delayed
 import multiprocessing
 
+import mc_solr
+import mc_solr_async
+import mc_solr_shards
+import word_count_deadline
+import word_count_metrics
+import word_count_pool
+import word_count_stemmer
+import word_count_tokenizer
+import word_count_top_k
+import word_count_vocabulary
 
-in_memory_word_count_threshold = 0
-
-def fetch_all( solr, fq, query, fields=None ) :
-    documents = []
-    num_matching_documents = solr.search( query, **{ 'fq': fq } ).hits
-
-    start = 0
-    #rows = num_matching_documents
-    rows = num_matching_documents
-
-    sys.stderr.write( " starting fetch for \n" + query )
-    while (len( documents ) < num_matching_documents):
-        sys.stderr.write( 'fetching {0} documents'.format( rows ) )
-        sys.stderr.write( "\n" );
-        results = solr.search( query, **{
-                'fq': fq,
-                'start': start,
-                'rows': rows,
-                'fl' : fields,
-                })
-        documents.extend( results.docs )
-        start += rows
-
-        assert len( documents ) <= num_matching_documents
-
-    assert len( documents ) == num_matching_documents
-    return documents
 
+in_memory_word_count_threshold = 0
 
 #tokenizer = RegexpTokenizer(r'\w+')
 
@@ -57,92 +42,123 @@ def tokenize( str ):
 #    return filter( lambda word : word not in { '-',',','.','!' }, regexp_tokenize(str, r'\w+' ) )
     return re.split( r'[\W\']+', str ) 
 
-def split_into_chunks( list, partitions ):
-    print "starting split_into_chunks"
-    partition_size = len( list ) / partitions
-    chunks = [ list[start:start+partition_size] for start in xrange( 0, len(list), partition_size ) ]
-
-    print "returning from split_into_chunks"
-    return chunks
-
-def get_frequency_counts( token_lists ):
-
-    sentences_processed = 0
-    freq = collections.Counter()
-
-    for token_list in token_lists:
-        #sentences_processed += 1
-        #if sentences_processed % 10000 == 0 :
-        #    print "Processed {} ".format( sentences_processed )
-        freq.update( token_list )
-
-    return freq
-    
-    
-def non_stemmed_word_count( sentences ):
-    start_time = time.time()
-    non_stemmed_word_count_start_time = start_time
-    print "starting  non_stemmed_word_count "
-    print time.asctime()
-
-    print 'tokenizing '
-
-   # token_lists = Parallel(n_jobs=8, verbose=5, pre_dispatch='3*n_jobs')(delayed ( tokenize)( sentence) for sentence in sentences )
-
-    pool = multiprocessing.Pool() 
-
-    token_lists = pool.map( tokenize, sentences )
-
-    pool.close()
-    pool.join()
-
-    end_time = time.time()
-    print 'done tokenizing'
-    print "time {}".format( str(end_time - start_time) )
-
-    print 'chunking '
-    start_time = time.time()
-
-    chunks = split_into_chunks( token_lists, 20 )
-
-    end_time = time.time()
-
-    print 'done chunking '
-    print "time {}".format( str(end_time - start_time) )
-
-
-    print 'getting freq counts'
-
-    start_time = time.time()
-    pool =  multiprocessing.Pool() 
-
-    freq_counts = pool.map( get_frequency_counts, chunks )
-
-    pool.close()
-    pool.join()
-
-    pool = None
-
-    end_time = time.time()
-    print "time {}".format( str(end_time - start_time) )
-    print 'done getting freq counts'
-
-    print "summing freq_counts "
-    start_time = end_time
+def get_frequency_counts( sentences ):
+    # Map step: lowercase, tokenize and count one page of sentences; only the
+    # partial counter is sent back to the parent
+    return word_count_tokenizer.count_page( sentences )
+
+def get_top_k_counts( sentences, capacity, deadline=None ):
+    # Map step of the top-k engine: like get_frequency_counts(), but only a
+    # summary of at most capacity terms is sent back (None once the request's
+    # deadline passed)
+    if word_count_deadline.expired( deadline ):
+        return None
+
+    return word_count_top_k.TopKSummary.from_counter( get_frequency_counts( sentences ), capacity )
+
+def merge_frequency_counts( levels, freq ):
+    # Reduce step: levels[ i ] holds either None or a counter merged from 2**i
+    # partial counters, so merging proceeds as a balanced binary tree and only
+    # O(log pages) partial counters are held at any time
+    level = 0
+    while level < len( levels ) and levels[ level ] is not None:
+        other = levels[ level ]
+        levels[ level ] = None
+        if len( other ) > len( freq ):
+            freq, other = other, freq
+        freq.update( other )
+        level += 1
+
+    if level == len( levels ):
+        levels.append( freq )
+    else:
+        levels[ level ] = freq
+
+def _merge_next_result( pending, merge ):
+    with word_count_metrics.stage_timer( 'count' ):
+        result = word_count_deadline.wait( pending.popleft() )
+
+    # workers skip the pages of requests that ran out of time
+    word_count_deadline.check()
+
+    with word_count_metrics.stage_timer( 'merge' ):
+        merge( result )
+
+def non_stemmed_word_count( sentence_pages, capacity=None ):
+    # sentence_pages is an iterable of lists of sentences (as produced by
+    # mc_solr_async.fetch_all_pages()); pages are handed to the shared worker pool as
+    # they arrive and at most max_pages_in_flight of them are queued at once, so
+    # peak memory is bounded by page size * workers rather than by corpus size.
+    #
+    # Exact counts are merged as word_count_vocabulary interned arrays.  With
+    # capacity set, counts are kept in word_count_top_k summaries of at most
+    # capacity terms and a TopKSummary is returned instead of a Counter.
+    #
+    # Time spent waiting on workers is recorded as the "count" stage and time
+    # spent merging their results as the "merge" stage.
+    #
+    # Raises word_count_deadline.DeadlineExceeded once the request's deadline
+    # passed; its pages still queued on the pool are skipped by the workers.
+    pool = word_count_pool.get_pool()
+    max_pages_in_flight = word_count_pool.max_tasks_in_flight()
+    deadline = word_count_deadline.get()
+
+    if capacity is None:
+        # exact counts: workers intern terms and send back integer arrays that
+        # are added straight into one counts array
+        request_id = uuid.uuid4().hex
+        interned_counts = word_count_vocabulary.InternedCounts()
+
+        submit = lambda sentences: pool.apply_async( word_count_vocabulary.count_page,
+                                                     ( request_id, sentences, deadline, word_count_vocabulary.released_requests() ) )
+        merge = interned_counts.add
+    else:
+        levels = []
+
+        submit = lambda sentences: pool.apply_async( get_top_k_counts, ( sentences, capacity, deadline ) )
+        merge = lambda summary: merge_frequency_counts( levels, summary )
+
+    pending = collections.deque()
+    num_pages = 0
+    num_sentences = 0
+
+    try:
+        for sentences in sentence_pages:
+            word_count_deadline.check()
+
+            if len( pending ) >= max_pages_in_flight:
+                _merge_next_result( pending, merge )
+
+            pending.append( submit( sentences ) )
+            num_pages += 1
+            num_sentences += len( sentences )
+
+        while pending:
+            _merge_next_result( pending, merge )
+    finally:
+        if capacity is None:
+            # the workers' tables for this request are no longer needed
+            word_count_vocabulary.release( request_id )
+
+    with word_count_metrics.stage_timer( 'merge' ):
+        if capacity is None:
+            freq = interned_counts.to_counter()
+            interned_counts = None
+        else:
+            # fold the remaining partial summaries into the largest one
+            partial_counts = sorted( [ freq_count for freq_count in levels if freq_count is not None ], key=len )
+            levels = None
 
-    freq = collections.Counter()
+            freq = partial_counts.pop() if partial_counts else word_count_top_k.TopKSummary( capacity )
 
-    for freq_count in freq_counts:
-        freq += freq_count
+            for freq_count in partial_counts:
+                freq.update( freq_count )
 
-    end_time = time.time()
+    word_count_metrics.observe( 'word_count_sentences', num_sentences )
+    word_count_metrics.observe( 'word_count_vocabulary_size', len( freq ) )
 
-    print "done summing freq_counts "
-    print "time {}".format( str(end_time - start_time) )
+    print 'counted {} terms in {} sentences ({} pages)'.format( len( freq ), num_sentences, num_pages )
 
-    print "Returning"
-    print time.asctime()
-    print "total subroution time: {} ".format( end_time - non_stemmed_word_count_start_time )
     return freq
 
 def in_memory_word_count( sentences ):
@@ -153,113 +169,73 @@ def in_memory_word_count( sentences ):
     return freq
 
 def solr_connection() :
-    return pysolr.Solr('http://localhost:8983/solr/')
-
-def get_word_counts( solr, fq, query, num_words, field='sentence' ) :
-    print query
-
-    print str(time.asctime())
-
-    start_time = time.time()
-
-    function_start_time = start_time
-    
-    results = fetch_all( solr, fq, query, 'sentence' )
-    print "got " + query
-    print len( results )
-    print time.asctime()
-
-    end_time = time.time()
-    print "time {}".format( str(end_time - start_time) )
-
-    start_time = end_time
-
-    print 'converting to utf8 and lowercasing';
-    sentences = [ result['sentence'].lower() for result in results ]
-
-    results = None
-
-    end_time = time.time()
-    print "time {}".format( str(end_time - start_time) )
-
-    start_time = end_time
-
+    return mc_solr.py_solr_connection()
+
+def _shard_pages( sort, fetch_shards ):
+    # Pages of fetch_shards( shard URLs ) if shard-direct fetching is enabled
+    # and Solr is sharded, otherwise None.  Shards return their documents in
+    # no particular order, so only a fetch of every matching document (no
+    # sort) can be spread over them.
+    if sort is not None or not mc_solr_shards.enabled():
+        return None
+
+    urls = mc_solr_shards.shard_urls()
+    if not urls or len( urls ) < 2:
+        return None
+
+    return fetch_shards( urls )
+
+def get_term_counts( solr, fq, query, field='sentence', num_matching_documents=None, sort=None, capacity=None ):
+    # Fetches every sentence matching the query (or the first
+    # num_matching_documents of them in sort order) and returns its unstemmed
+    # term counts (a top-k summary if capacity is set); the next page is
+    # fetched while the current one is handed to the workers
+    pages = _shard_pages( sort, lambda urls: mc_solr_shards.fetch_all_pages( query, fq, field, urls=urls ) )
+    if pages is None:
+        pages = mc_solr_async.fetch_all_pages( solr, query, fq, field, num_matching_documents, sort=sort )
+    pages = word_count_metrics.timed_iterator( pages, 'fetch' )
+    sentence_pages = ( [ result[ field ] for result in page ] for page in pages )
+
+    return non_stemmed_word_count( sentence_pages, capacity )
+
+def get_term_vector_counts( solr, fq, query, field='sentence', num_matching_documents=None ):
+    # Like get_term_counts(), but sums the term frequencies Solr recorded for
+    # field at index time instead of fetching and tokenizing the stored text.
+    # Terms are those of the field's analyzer, so stopwords aren't counted.
+    pages = _shard_pages( None, lambda urls: mc_solr_shards.fetch_all_term_vector_pages( query, field, fq, urls=urls ) )
+    if pages is None:
+        pages = mc_solr.fetch_all_term_vector_pages( solr, query, field, fq, num_matching_documents )
+    pages = word_count_metrics.timed_iterator( pages, 'fetch' )
 
-    print 'calculating non_stemmed_wordcounts'
-    term_counts = non_stemmed_word_count( sentences )
-
-    if '' in term_counts:
-        del term_counts['']
-
-    print "Returned from non_stemmed_word_count"
-    print time.asctime()
-    end_time = time.time()
-    print "time {}".format( str(end_time - start_time) )
-
-    start_time = end_time
-    print "freeing sentences "
-    sentences = None
-    
-    end_time = time.time()
-    print "time {}".format( str(end_time - start_time) )
-
-
-    start_time = end_time
-
-    print 'stemming and counting'
-
-    stem_counts = collections.Counter()
-
-    st = PorterStemmer()
-    for term in term_counts.keys():
-        #ipdb.set_trace()
-        stem = st.stem_word( term )
-        stem_counts[ stem ] += term_counts[ term ]
-
-
-    end_time = time.time()
-    print "done stemming and counting "
-    print "time {}".format( str(end_time - start_time) )
-
-    start_time = end_time
+    freq = collections.Counter()
+    num_sentences = 0
 
-    print ' calcuating stem to term map '
-    stem_to_terms = {}
-    for term in term_counts.keys():
-        stem = st.stem_word( term )
-        if stem not in stem_to_terms:
-            stem_to_terms[ stem ] = []
+    for page in pages:
+        word_count_deadline.check()
 
-        stem_to_terms[stem].append( term )
+        with word_count_metrics.stage_timer( 'merge' ):
+            for term_frequencies in page:
+                freq.update( term_frequencies )
 
-    print "done calcuating stem to term map "
-    print "time {}".format( str(end_time - start_time) )
+        num_sentences += len( page )
 
+    word_count_metrics.observe( 'word_count_sentences', num_sentences )
+    word_count_metrics.observe( 'word_count_vocabulary_size', len( freq ) )
 
-    counts = stem_counts.most_common( num_words )
+    print 'summed {} terms from the term vectors of {} sentences'.format( len( freq ), num_sentences )
 
-    ret = [ ]
-    for stem, count in counts:
-        if len( stem_to_terms[ stem ] ) < 2:
-            term = stem_to_terms[ stem][0]
-        else:
-            best_count = 0
-            for possible_best in stem_to_terms[ stem ] :
-                if term_counts[ possible_best ] > best_count:
-                    term = possible_best
-                    best_count = term_counts[ possible_best ]
+    return freq
 
-        ret.append( 
-            { 'stem': stem, 
-              'term': term,
-              'count': count
-              } )
+def get_stemmed_word_counts( term_counts, num_words ):
+    with word_count_metrics.stage_timer( 'stem' ):
+        return word_count_stemmer.top_stemmed_counts( term_counts, num_words )
 
+def get_word_counts( solr, fq, query, num_words, field='sentence', num_matching_documents=None ) :
+    print query
 
-    end_time  = time.time()
-    print "total time {}".format( str(end_time - function_start_time) )
+    term_counts = get_term_counts( solr, fq, query, field, num_matching_documents )
 
-    return ret
+    return get_stemmed_word_counts( term_counts, num_words )
 
 def main():
 
@@ -1,38 +1,14 @@
 #!/usr/bin/python
 
-import requests
 import ipdb
 import time
 import csv
 import sys
 import pysolr
 
-def fetch_all( solr, query ) :
-    documents = []
-    num_matching_documents = solr.search( query ).hits
+import mc_solr
 
-    start = 0
-    rows = num_matching_documents
-
-    sys.stderr.write( ' starting fetch for ' + query )
-    sys.stderr.write( 'fetching {0} documents'.format( rows ) )
-    while ( len( documents ) < num_matching_documents ) :
-        results = solr.search( query, **{ 
-                'start': start,
-                'rows': rows,
-               # 'fl' : 'media_id',
-                })
-        documents.extend( results.docs )
-        start += rows
-
-        assert len( documents ) <= num_matching_documents
-
-    assert len( documents ) == num_matching_documents
-    return documents
-
-
-
-solr = pysolr.Solr('http://localhost:8983/solr/')
+solr = mc_solr.py_solr_connection( 'http://localhost:8983/solr/' )
 
 queries = [ 'sentence:obama',
             ]
@@ -40,12 +16,15 @@ file=open('out.txt','wb')
 
 for query in queries:
    print query
-   results = fetch_all( solr, query )
-   print "got " + query
-   print len( results )
+   num_sentences = 0
+   for result in mc_solr.fetch_all( solr, query ):
+       if num_sentences > 0:
+           file.write("\n")
+       file.write( result['sentence'].encode('utf-8') )
+       num_sentences += 1
 
-   sentences = [ result['sentence'].encode('utf-8') for result in results ]
-   file.write("\n".join( sentences))
+   print "got " + query
+   print num_sentences
    #file.writelines( sentences )
 
    #ipdb.set_trace()
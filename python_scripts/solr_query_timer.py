@@ -1,44 +1,24 @@
 #!/usr/bin/python
 
-import requests
 import ipdb
 import time
 import csv
 import sys
 import pysolr
 
-def _fetch_all( solr, query ) :
-    documents = []
-    num_matching_documents = solr.search( query ).hits
-
-    start = 0
-    rows = num_matching_documents
-
-    sys.stderr.write( ' starting fetch for ' + query )
-    while ( len( documents ) < num_matching_documents ) :
-        results = solr.search( query, **{ 
-                'start': start,
-                'rows': rows,
-               # 'fl' : 'media_id',
-                })
-        documents.extend( results.docs )
-        start += rows
-
-        assert len( documents ) <= num_matching_documents
-
-    assert len( documents ) == num_matching_documents
-    return documents
+import mc_solr
 
 def time_to_fetch_all( solr, query ) :
     start = time.time()
-    _fetch_all( solr, query )
+    for document in mc_solr.fetch_all( solr, query ):
+        pass
     end = time.time()
     return end - start
 
 
 url_file = 'urls.txt'
 
-solr = pysolr.Solr('http://localhost:8983/solr/')
+solr = mc_solr.py_solr_connection( 'http://localhost:8983/solr/' )
 
 queries = [ 'sentence:obama',
             'sentence:mccain', 
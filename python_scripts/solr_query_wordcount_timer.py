@@ -4,66 +4,363 @@ import ipdb
 #import time
 #import csv
 import sys
+import collections
+import math
+import random
 import pysolr
 import dateutil.parser
+import mc_config
+import mc_solr
 import solr_in_memory_wordcount_stemmed
+import word_count_days
+import word_count_deadline
+import word_count_metrics
+import word_count_stemmer
 
+# Queries matching at least this many sentences are never counted in memory
 in_memory_word_count_threshold = 10000000
 
-def get_word_counts( solr, query, date_str, num_words=1000 ) :
-    documents = []
+# Cost model used by choose_engine(): approximate sentences per second the
+# in-memory engine fetches and counts, and the fixed cost (in seconds) and
+# sentences per second of a facet request counted inside Solr.  Facet counts
+# are sentence frequencies without stopwords rather than stemmed occurrences,
+# so the cost model only considers them for queries matching at least
+# word_count.in_solr_min_documents sentences (by default the threshold above)
+in_memory_sentences_per_second = 50000
+in_solr_fixed_cost = 2.0
+in_solr_sentences_per_second = 2000000
+
+# Stemming merges several facet terms into one stem, so ask Solr for more terms
+# than the number of words requested
+in_solr_facet_limit_factor = 2
+
+# Sampling: an automatically sized sample is as large as the in-memory engine
+# can count within what is left of sample_latency_target seconds once Solr has
+# sorted every matching sentence by a random field (at about
+# sample_sort_sentences_per_second), but never smaller than min_sample_size
+# sentences
+sample_latency_target = 5.0
+sample_sort_sentences_per_second = 20000000
+min_sample_size = 10000
+
+# Queries matching at least this many sentences (and so likely having a huge
+# vocabulary) are no longer counted with an exact in-memory engine but with
+# the top-k engine, which keeps top_k_capacity_factor * num_words terms per
+# summary and counts about top_k_sentences_per_second; it competes with the
+# in_solr engine on cost like the exact engines do below that size
+top_k_min_documents = 1000000
+top_k_capacity_factor = 10
+top_k_sentences_per_second = 45000
+
+engines = ( 'in_memory', 'in_solr', 'top_k', 'term_vectors' )
+
+# Field the term_vectors engine reads: a copy of sentence with termVectors
+# enabled (see schema.xml)
+term_vector_field = 'sentence_tv'
+
+# Largest number of words a request may ask for; the service computes every
+# result at this size and serves smaller requests from its top words
+max_num_words = 5000
+
+# Engines whose exact term counts can be kept and topped up with the counts of
+# newly indexed sentences
+incremental_engines = ( 'in_memory', 'term_vectors' )
+
+def watermark_filter( start, end ):
+    # Filter for the sentences with start < processed_stories_id <= end; either
+    # may be None for no bound
+    return 'processed_stories_id:{{{0} TO {1}]'.format( '*' if start is None else start, '*' if end is None else end )
+
+def search( solr, q, **params ):
+    # solr.search(), but Solr is given what is left of the request's deadline
+    # as timeAllowed and a result it cut short raises
+    # word_count_deadline.DeadlineExceeded.  (Cursor queries can't take
+    # timeAllowed; their pages are waited for with word_count_deadline.wait().)
+    remaining = word_count_deadline.remaining()
+    if remaining is None:
+        return solr.search( q, **params )
+
+    word_count_deadline.check()
+
+    params[ 'timeAllowed' ] = max( int( remaining * 1000 ), 1 )
+
+    # pysolr's Results drop the response header that tells of partial results
+    response = mc_solr.search_handler( solr, 'select', q, **params )
+
+    if response.get( 'responseHeader', {} ).get( 'partialResults' ):
+        raise word_count_deadline.DeadlineExceeded( 'request deadline exceeded' )
+
+    return pysolr.Results( response[ 'response' ][ 'docs' ], response[ 'response' ][ 'numFound' ], facets=response.get( 'facet_counts' ) )
+
+def use_term_vectors():
+    # Whether the collection has term vectors in term_vector_field, in which
+    # case they replace the in-memory engine
+    return str( mc_config.word_count_config().get( 'use_term_vectors' ) or 'no' ).lower() in ( 'yes', 'true', '1' )
 
+def get_word_counts( solr, query, date_str, num_words=1000 ) :
+    # query is a dict with a start_date, an end_date and optionally the Solr
+    # query q (all sentences by default)
     fq = get_fq( query )
 
-    return _get_word_counts_impl( solr, fq, num_words )
+    return _get_word_counts_impl( solr, fq, num_words, query.get( 'q' ) or '*:*' )[ 'counts' ]
+
+def get_word_counts_for_service( solr, fq, num_words, q, engine=None, sample=None, watermark=None ):
+    # With a processed_stories_id watermark, a result counted exactly by one of
+    # the incremental_engines only counts the sentences up to the watermark
+    # and also holds their unstemmed 'term_counts'; results of other engines
+    # count every sentence, as the sentences above the watermark couldn't be
+    # added to them later on
+    return _get_word_counts_impl( solr, fq, num_words, q, engine, sample, watermark )
+
+def refresh_word_counts( solr, fq, num_words, q, engine, term_counts ):
+    # Counts the sentences matching q and fq (e.g. those above a
+    # processed_stories_id watermark) with engine and adds them to the term
+    # counts of an earlier result; returns ( result, merged term counts )
+    with word_count_metrics.stage_timer( 'total' ):
+        new_term_counts = _exact_term_counts( solr, fq, q, engine )
+
+        with word_count_metrics.stage_timer( 'merge' ):
+            merged_term_counts = collections.Counter( term_counts )
+            merged_term_counts.update( new_term_counts )
+
+        counts = solr_in_memory_wordcount_stemmed.get_stemmed_word_counts( merged_term_counts, num_words )
+
+    word_count_metrics.increment( 'word_count_requests_total', engine=engine + '_refresh' )
+
+    return { 'counts': counts, 'engine': engine }, merged_term_counts
+
+def in_solr_min_documents():
+    # Fewest matching sentences for which the cost model may pick the in_solr
+    # engine
+    min_documents = mc_config.word_count_config().get( 'in_solr_min_documents' )
+
+    return in_memory_word_count_threshold if min_documents is None else int( min_documents )
+
+def choose_engine( matching_documents ):
+    if matching_documents >= in_memory_word_count_threshold:
+        return 'in_solr'
+
+    # the engine counting in memory: exact up to top_k_min_documents, bounded
+    # memory beyond
+    if matching_documents >= top_k_min_documents:
+        engine = 'top_k'
+        cost = float( matching_documents ) / top_k_sentences_per_second
+    else:
+        engine = 'term_vectors' if use_term_vectors() else 'in_memory'
+        cost = float( matching_documents ) / in_memory_sentences_per_second
+
+    in_solr_cost = in_solr_fixed_cost + float( matching_documents ) / in_solr_sentences_per_second
+
+    if matching_documents >= in_solr_min_documents() and cost > in_solr_cost:
+        return 'in_solr'
 
-def get_word_counts_for_service( solr, fq, num_words, q ):
-    return _get_word_counts_impl( solr, fq, num_words, q )
+    return engine
 
-def _get_word_counts_impl( solr, fq, num_words, q ):
+def valid_sample( sample ):
+    # Whether sample is "auto", "true", "false" or a non-negative number of
+    # sentences
+    if not sample or unicode( sample ).lower() in ( u'auto', u'true', u'false' ):
+        return True
+
+    try:
+        return int( sample ) >= 0
+    except ValueError:
+        return False
+
+def choose_sample_size( matching_documents, sample ):
+    # sample is either "auto" (or "true") or the number of sentences to sample;
+    # returns None if sampling is off
+    if not valid_sample( sample ):
+        raise Exception( u"invalid sample '{}'".format( sample ) )
+
+    if not sample or unicode( sample ).lower() in ( u'0', u'false' ):
+        return None
+
+    if unicode( sample ).lower() in ( u'auto', u'true' ):
+        # the more sentences match, the longer the random sort takes and the
+        # less time is left for counting
+        sort_seconds = float( matching_documents ) / sample_sort_sentences_per_second
+        count_seconds = max( sample_latency_target - sort_seconds, 0 )
+
+        return max( int( count_seconds * in_memory_sentences_per_second ), min_sample_size )
+
+    return int( sample )
+
+def _get_word_counts_impl( solr, fq, num_words, q, engine=None, sample=None, watermark=None ):
+    with word_count_metrics.stage_timer( 'total' ):
+        ret = _count_words( solr, fq, num_words, q, engine, sample, watermark )
+
+    word_count_metrics.increment( 'word_count_requests_total', engine=ret[ 'engine' ] + ( '_sample' if 'sample' in ret else '' ) )
+
+    return ret
+
+def _count_words( solr, fq, num_words, q, engine=None, sample=None, watermark=None ):
+    # Returns a { counts, engine } dict; engine is picked by choose_engine()
+    # unless the caller forces one.  With sample set, queries matching more
+    # sentences than the sample size are counted from a uniform random sample
+    # and the reply also holds a sample dict.  See get_word_counts_for_service()
+    # for watermark.
 
     print int(num_words )
-    num_words = min ( int(num_words), 5000 )
+    num_words = min ( int(num_words), max_num_words )
 
     print "{0} word will be returned".format( num_words)
-    matching_documents = solr.search( q, **{ 'fq': fq } ).hits
+    with word_count_metrics.stage_timer( 'hits' ):
+        matching_documents = search( solr, q, **{ 'fq': fq, 'rows': 0 } ).hits
+
+    word_count_metrics.observe( 'word_count_matching_documents', matching_documents )
 
-    print "q:{0}, fq:{1} \n".format( q, fq )
+    print u"q:{0}, fq:{1} \n".format( q, fq ).encode( 'utf-8' )
 
     print "{0} matching documents ".format( matching_documents )
 
-    if (matching_documents < in_memory_word_count_threshold) and (in_memory_word_count_threshold > 0):
-        return in_memory_word_count(  solr, fq, num_words, q )
+    if engine is not None and engine not in engines:
+        raise Exception( "unknown word count engine '{}'".format( engine ) )
+
+    sample_size = choose_sample_size( matching_documents, sample ) if engine != 'in_solr' else None
+
+    if sample_size is not None and sample_size < matching_documents:
+        print "counting a sample of {} sentences".format( sample_size )
+
+        counts, sample_info = sampled_word_count( solr, fq, num_words, q, matching_documents, sample_size )
+
+        return { 'counts': counts, 'engine': 'in_memory', 'sample': sample_info }
+
+    if engine is None:
+        engine = choose_engine( matching_documents )
+
+    print "counting with the {} engine".format( engine )
+
+    if watermark is not None and engine in incremental_engines:
+        # counted in one go: per-day counts would be cached under the
+        # processed_stories_id filter (matching_documents still bounds the
+        # number of sentences fetched)
+        exact_term_counts = _exact_term_counts( solr, fq + [ watermark_filter( None, watermark ) ], q, engine, matching_documents )
+        counts = solr_in_memory_wordcount_stemmed.get_stemmed_word_counts( exact_term_counts, num_words )
+
+        return { 'counts': counts, 'engine': engine, 'term_counts': exact_term_counts }
+
+    if engine == 'in_memory':
+        counts = in_memory_word_count(  solr, fq, num_words, q, matching_documents )
+    elif engine == 'top_k':
+        counts = top_k_word_count( solr, fq, num_words, q, matching_documents )
+    elif engine == 'term_vectors':
+        counts = term_vector_word_count( solr, fq, num_words, q, matching_documents )
     else:
-        raise Exception ("unimplemented")
-        return in_solr_word_count( solr, fq, num_words, q )
+        counts = in_solr_word_count( solr, fq, num_words, q )
 
-def in_solr_word_count( solr, fq, num_words, q='*:*' ):
-    facet_field = "includes"
+    return { 'counts': counts, 'engine': engine }
+
+def in_solr_word_count( solr, fq, num_words, q='*:*', field='sentence' ):
+    # Counts words inside Solr by faceting on the indexed sentence field, so no
+    # sentence text is transferred.  Facet counts are the number of matching
+    # sentences that contain a term rather than the number of occurrences, and
+    # terms dropped by the field's stopword filter are not counted.
 
     query_params = { 
+            'rows': 0,
             'facet':"true",
-            "facet.limit": num_words,
-            "facet.field": facet_field,
-            "facet.method":"enum",
-            "fq": fq,
+            "facet.limit": num_words * in_solr_facet_limit_factor,
+            "facet.mincount": 1,
+            "facet.field": field,
+            "facet.method":"fc",
             }
 
-    #query_params['fq'] = " AND ".join( query_params['fq'] )
+    if fq:
+        query_params['fq'] = fq
+
+    with word_count_metrics.stage_timer( 'facet' ):
+        results = search( solr, q, ** query_params)
+
+    facets = results.facets['facet_fields'][ field ]
+
+    term_counts = dict(zip(facets[0::2],facets[1::2]))
+
+    return word_count_stemmer.top_stemmed_counts( term_counts, num_words )
+    
+
+def sampled_word_count( solr, fq, num_words, q, matching_documents, sample_size ):
+    # Counts a uniform random sample of the matching sentences (the first
+    # sample_size sentences under a freshly seeded random sort) and scales the
+    # counts up to the full result set.  Each count gets an error: the half width
+    # of its 95% confidence interval, treating the sampled count as Poisson and
+    # applying the finite population correction.
+    sort = 'random_{} asc, solr_id asc'.format( random.randint( 0, 2 ** 31 - 1 ) )
+
+    term_counts = solr_in_memory_wordcount_stemmed.get_term_counts( solr, fq, q, 'sentence', sample_size, sort )
+
+    counts = solr_in_memory_wordcount_stemmed.get_stemmed_word_counts( term_counts, num_words )
 
-    results = solr.search( q, ** query_params)
+    scale = float( matching_documents ) / sample_size
+    population_correction = math.sqrt( 1.0 - float( sample_size ) / matching_documents )
 
-    #ipdb.set_trace()
+    for count in counts:
+        sample_count = count[ 'count' ]
+        count[ 'count' ] = int( round( sample_count * scale ) )
+        count[ 'error' ] = int( math.ceil( 1.96 * scale * math.sqrt( sample_count ) * population_correction ) )
 
-    facets = results.facets['facet_fields']['includes']
+    sample_info = {
+        'size': sample_size,
+        'matching_documents': matching_documents,
+        'scale': scale,
+        }
 
-    counts = dict(zip(facets[0::2],facets[1::2]))
+    return counts, sample_info
+
+def top_k_word_count( solr, fq, num_words, q, num_matching_documents=None ):
+    # In-memory counting whose memory is bounded by num_words rather than by the
+    # vocabulary.  Counts are exact when the vocabulary fits in the summaries;
+    # otherwise they are overestimates and each gets an error bound.
+    capacity = num_words * top_k_capacity_factor
+
+    summary = solr_in_memory_wordcount_stemmed.get_term_counts( solr, fq, q, 'sentence', num_matching_documents, capacity=capacity )
+
+    with word_count_metrics.stage_timer( 'stem' ):
+        stem_counts, stem_to_terms, best_terms = word_count_stemmer.stem_term_counts( summary )
+
+    counts = []
+    for stem, count in stem_counts.most_common( num_words ):
+        word_count = { 'stem': stem, 'term': best_terms[ stem ], 'count': count }
+
+        if not summary.is_exact():
+            word_count[ 'error' ] = sum( summary.error( term ) for term in stem_to_terms[ stem ] )
+
+        counts.append( word_count )
 
     return counts
-    
 
-def in_memory_word_count( solr, fq, num_words, q ):
-    return solr_in_memory_wordcount_stemmed.get_word_counts( solr, fq, q, num_words,'sentence' )
+def term_vector_word_count( solr, fq, num_words, q, num_matching_documents=None ):
+    # Sums the indexed term frequencies of the matching sentences; no sentence
+    # text is transferred or tokenized in Python
+    term_counts = _term_vector_counts( solr, fq, q, num_matching_documents )
+
+    return solr_in_memory_wordcount_stemmed.get_stemmed_word_counts( term_counts, num_words )
+
+def _term_vector_counts( solr, fq, q, num_matching_documents=None ):
+    # Falls back to fetching the sentences if the collection turns out not to
+    # have term vectors (e.g. use_term_vectors was set before reindexing)
+    try:
+        return solr_in_memory_wordcount_stemmed.get_term_vector_counts( solr, fq, q, term_vector_field, num_matching_documents )
+    except mc_solr.MissingTermVectors, e:
+        sys.stderr.write( 'term vectors unavailable, counting in memory: {0}\n'.format( e ) )
+
+    return solr_in_memory_wordcount_stemmed.get_term_counts( solr, fq, q, 'sentence', num_matching_documents )
+
+def _exact_term_counts( solr, fq, q, engine, num_matching_documents=None ):
+    # Unstemmed term counts of every matching sentence
+    if engine == 'term_vectors':
+        return _term_vector_counts( solr, fq, q, num_matching_documents )
+
+    return solr_in_memory_wordcount_stemmed.get_term_counts( solr, fq, q, 'sentence', num_matching_documents )
+
+def in_memory_word_count( solr, fq, num_words, q, num_matching_documents=None ):
+    # date range queries are answered from per-day partial counts where possible
+    term_counts = word_count_days.get_term_counts( solr, fq, q )
+
+    if term_counts is None:
+        return solr_in_memory_wordcount_stemmed.get_word_counts( solr, fq, q, num_words,'sentence', num_matching_documents )
+
+    return solr_in_memory_wordcount_stemmed.get_stemmed_word_counts( term_counts, num_words )
 
 def get_fq(  query ) :
     start_date = dateutil.parser.parse( query['start_date'] )
@@ -104,7 +401,7 @@ def counts_to_db_style( counts ) :
                       
 
 def solr_connection() :
-    return pysolr.Solr('http://localhost:8983/solr/')
+    return mc_solr.py_solr_connection()
 
 def main():
 
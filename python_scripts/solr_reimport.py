@@ -1,8 +1,8 @@
 #!/usr/bin/python
 
-import requests
 import ipdb
 import mc_config
+import mc_solr
 import psycopg2
 import psycopg2.extras
 import time
@@ -44,8 +44,7 @@ print "min_story_sentences_id: {} ".format( min_story_sentences_id)
 import_batch_size = 1000000
 
 while True:
-    r = requests.get( 'http://localhost:8983/solr/collection1/dataimport?command=status&wt=json', headers = { 'Accept': 'application/json'})  
-    data = r.json()
+    data = mc_solr.dataimport_status()
 
     if data['status'] != 'busy':
         print data
@@ -71,7 +70,7 @@ while True:
 
         min_story_sentences_id += import_batch_size
 
-        requests.get( 'http://localhost:8983/solr/collection1/dataimport?command=full-import&commit=true&clean=false' )
+        mc_solr.dataimport_delta_import()
     else:
         print "import busy"
 
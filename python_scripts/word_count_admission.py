@@ -0,0 +1,176 @@
+#!/usr/bin/python
+
+#
+# Admission control for word count computations
+#
+# At most max_concurrent computations run at once; up to max_queued more wait
+# for a slot and anything beyond that is rejected right away, so that a burst
+# of huge queries can't exhaust the memory or CPUs of the box.  A request that
+# waits longer than max_queue_seconds (or past its deadline) is rejected too.
+#
+# Requests have a priority class.  Waiting "interactive" requests are admitted
+# before waiting "batch" requests, and batch requests never hold more than
+# max_concurrent_batch of the slots, so small interactive queries aren't stuck
+# behind batch jobs.
+#
+
+import heapq
+import itertools
+import threading
+
+import word_count_deadline
+
+# priority class -> rank; lower ranks are admitted first
+priorities = {
+    'interactive': 0,
+    'batch': 1,
+    }
+
+default_priority = 'interactive'
+
+class Rejected( Exception ):
+    pass
+
+class _Waiter( object ):
+
+    def __init__( self, priority ):
+        self.priority = priority
+        self.admitted = False
+        self.event = threading.Event()
+
+class AdmissionController( object ):
+
+    def __init__( self, max_concurrent=4, max_queued=16, max_queue_seconds=30, max_concurrent_batch=None ):
+        # 0 (or None) for max_concurrent, max_queued or max_queue_seconds means
+        # no limit
+        self.max_concurrent = max_concurrent or None
+        self.max_queued = max_queued
+        self.max_queue_seconds = max_queue_seconds or None
+        self.max_concurrent_batch = max_concurrent_batch
+
+        self._lock = threading.Lock()
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._running = dict( ( priority, 0 ) for priority in priorities )
+
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def _has_slot( self, priority ):
+        running = sum( self._running.values() )
+        if self.max_concurrent is not None and running >= self.max_concurrent:
+            return False
+
+        if priority == 'batch' and self.max_concurrent_batch is not None and self._running[ 'batch' ] >= self.max_concurrent_batch:
+            return False
+
+        return True
+
+    def _admit_waiting( self ):
+        # Hands free slots to waiters in priority (then arrival) order; a batch
+        # waiter without a slot doesn't hold up the interactive waiters behind it
+        skipped = []
+
+        while self._waiting:
+            entry = heapq.heappop( self._waiting )
+            waiter = entry[ 2 ]
+
+            if waiter.event.is_set():
+                # gave up waiting
+                continue
+
+            if not self._has_slot( waiter.priority ):
+                skipped.append( entry )
+                if self.max_concurrent is not None and sum( self._running.values() ) >= self.max_concurrent:
+                    break
+                continue
+
+            self._running[ waiter.priority ] += 1
+            waiter.admitted = True
+            waiter.event.set()
+
+        for entry in skipped:
+            heapq.heappush( self._waiting, entry )
+
+    def _num_waiting( self ):
+        return len( [ entry for entry in self._waiting if not entry[ 2 ].event.is_set() ] )
+
+    def acquire( self, priority=None ):
+        # Waits for a slot; raises Rejected if the queue is full or no slot
+        # came up in time, and word_count_deadline.DeadlineExceeded if the
+        # request's deadline passed while waiting
+        if priority is None:
+            priority = default_priority
+        if priority not in priorities:
+            raise Exception( "unknown priority class '{}'".format( priority ) )
+
+        waiter = _Waiter( priority )
+
+        with self._lock:
+            heapq.heappush( self._waiting, ( priorities[ priority ], next( self._sequence ), waiter ) )
+            self._admit_waiting()
+
+            if waiter.admitted:
+                self.admitted += 1
+                return priority
+
+            if self.max_queued and self._num_waiting() > self.max_queued:
+                waiter.event.set()
+                self.rejected += 1
+                raise Rejected( 'too many word count requests waiting' )
+
+        timeout = self.max_queue_seconds
+        remaining = word_count_deadline.remaining()
+        if remaining is not None and ( timeout is None or remaining < timeout ):
+            timeout = remaining
+
+        waiter.event.wait( timeout )
+
+        with self._lock:
+            if not waiter.admitted:
+                # mark it as given up; _admit_waiting() drops it
+                waiter.event.set()
+                self.timed_out += 1
+
+                word_count_deadline.check()
+                raise Rejected( 'no word count slot became free within {} seconds'.format( self.max_queue_seconds ) )
+
+            self.admitted += 1
+
+        return priority
+
+    def release( self, priority ):
+        with self._lock:
+            self._running[ priority ] -= 1
+            self._admit_waiting()
+
+    def admit( self, priority=None ):
+        # Context manager holding a slot for the duration of the block
+        return _Admission( self, priority )
+
+    def stats( self ):
+        with self._lock:
+            return {
+                'running': dict( self._running ),
+                'waiting': self._num_waiting(),
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+                'max_concurrent': self.max_concurrent,
+                'max_queued': self.max_queued,
+                }
+
+class _Admission( object ):
+
+    def __init__( self, controller, priority ):
+        self.controller = controller
+        self.priority = priority
+
+    def __enter__( self ):
+        self.priority = self.controller.acquire( self.priority )
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.controller.release( self.priority )
+        return False
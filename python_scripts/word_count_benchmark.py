@@ -0,0 +1,279 @@
+#!/usr/bin/python
+
+#
+# Reproducible word count benchmarks
+#
+# Generates a synthetic corpus of each size (word_count_benchmark_corpus.py),
+# serves it from a local Solr stand-in (fake_solr_server.py) and times each
+# stage of the word count pipeline on it:
+#
+#   fetch         cursor paging through every sentence with mc_solr.fetch_all_pages()
+#   tokenize      word_count_tokenizer.tokenize_batch() on every page
+#   count         word_count_tokenizer.count_page() on every page, merged in one process
+#   pool_count    non_stemmed_word_count() of every page on the worker pool
+#   stem          word_count_stemmer.top_stemmed_counts() with a cold stem memo
+#   in_memory     a whole in-memory engine request, from hit count to stemmed counts
+#   top_k         a whole top-k engine request
+#   term_vectors  a whole term vector engine request
+#
+# Nothing but the local machine is needed, and the word count settings are the
+# defaults from config/defaults.yml rather than the local mediawords.yml.  Each
+# scenario runs --repeat times and the fastest run is kept.
+#
+# Results are written as JSON.  When a baseline exists (the results of an
+# earlier run on the same machine, saved with --save-baseline) every scenario is
+# compared against it and the script exits with status 1 if any of them got
+# more than --max-regression slower.
+#
+# Usage:
+#
+#   word_count_benchmark.py --save-baseline        # on master
+#   word_count_benchmark.py --output results.json  # on a branch
+#
+
+import argparse
+import collections
+import datetime
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+import fake_solr_server
+import mc_config
+import mc_solr
+import solr_in_memory_wordcount_stemmed
+import solr_query_wordcount_timer
+import word_count_benchmark_corpus
+import word_count_pool
+import word_count_stemmer
+import word_count_tokenizer
+
+default_sizes = ( 10000, 100000, 300000 )
+
+default_baseline_path = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'word_count_benchmark_baseline.json' )
+
+# Scenarios that ran for less than this many seconds in the baseline are too
+# noisy to flag
+min_regression_seconds = 0.05
+
+num_words = 500
+
+def _fetch( context ):
+    for page in mc_solr.fetch_all_pages( context[ 'solr' ], '*:*', fields='sentence' ):
+        pass
+
+def _tokenize( context ):
+    for sentences in context[ 'pages' ]:
+        word_count_tokenizer.tokenize_batch( sentences )
+
+def _count( context ):
+    freq = collections.Counter()
+    for sentences in context[ 'pages' ]:
+        freq.update( word_count_tokenizer.count_page( sentences ) )
+
+def _pool_count( context ):
+    solr_in_memory_wordcount_stemmed.non_stemmed_word_count( iter( context[ 'pages' ] ) )
+
+def _stem( context ):
+    word_count_stemmer.clear_memo()
+    word_count_stemmer.top_stemmed_counts( context[ 'term_counts' ], num_words )
+
+def _engine_request( engine ):
+    return lambda context: solr_query_wordcount_timer.get_word_counts_for_service( context[ 'solr' ], [], num_words, '*:*', engine=engine )
+
+scenarios = collections.OrderedDict( [
+        ( 'fetch', _fetch ),
+        ( 'tokenize', _tokenize ),
+        ( 'count', _count ),
+        ( 'pool_count', _pool_count ),
+        ( 'stem', _stem ),
+        ( 'in_memory', _engine_request( 'in_memory' ) ),
+        ( 'top_k', _engine_request( 'top_k' ) ),
+        ( 'term_vectors', _engine_request( 'term_vectors' ) ),
+        ] )
+
+def time_scenario( function, context, repeat ):
+    # Returns the wall clock seconds of each of repeat runs
+    times = []
+    for i in range( repeat ):
+        gc.collect()
+
+        start_time = time.time()
+        function( context )
+        times.append( time.time() - start_time )
+
+    return times
+
+def run_size( num_sentences, scenario_names, repeat, vocabulary_size, seed ):
+    # Returns { scenario name: result } for a corpus of num_sentences sentences
+    print >> sys.stderr, "generating {} sentences".format( num_sentences )
+
+    documents = word_count_benchmark_corpus.generate_documents( num_sentences, vocabulary_size, seed )
+
+    sentences = [ document[ 'sentence' ] for document in documents ]
+    pages = [ sentences[ i:i + mc_solr.fetch_page_size ] for i in range( 0, len( sentences ), mc_solr.fetch_page_size ) ]
+
+    term_counts = collections.Counter()
+    for page in pages:
+        term_counts.update( word_count_tokenizer.count_page( page ) )
+
+    process, url = fake_solr_server.start_in_process( documents )
+    documents = None
+
+    try:
+        context = {
+            'solr': mc_solr.py_solr_connection( url ),
+            'pages': pages,
+            'term_counts': term_counts,
+            }
+
+        results = collections.OrderedDict()
+        for name in scenario_names:
+            print >> sys.stderr, "running {} on {} sentences".format( name, num_sentences )
+
+            times = time_scenario( scenarios[ name ], context, repeat )
+
+            results[ name ] = {
+                'seconds': min( times ),
+                'mean_seconds': sum( times ) / len( times ),
+                'runs': times,
+                'sentences': num_sentences,
+                'sentences_per_second': num_sentences / min( times ) if min( times ) else None,
+                }
+    finally:
+        process.terminate()
+        process.join()
+
+    return results
+
+def run( sizes, scenario_names, repeat, vocabulary_size, seed ):
+    results = {
+        'parameters': {
+            'vocabulary_size': vocabulary_size,
+            'seed': seed,
+            'fetch_page_size': mc_solr.fetch_page_size,
+            'pool_size': word_count_pool.pool_size(),
+            'num_words': num_words,
+            },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': multiprocessing.cpu_count(),
+            'date': datetime.datetime.utcnow().strftime( '%Y-%m-%dT%H:%M:%SZ' ),
+            },
+        'results': collections.OrderedDict(),
+        }
+
+    for num_sentences in sizes:
+        for name, result in run_size( num_sentences, scenario_names, repeat, vocabulary_size, seed ).iteritems():
+            results[ 'results' ][ '{}/{}'.format( name, num_sentences ) ] = result
+
+    return results
+
+def compare( results, baseline, max_regression ):
+    # Returns a list of ( scenario, baseline seconds, seconds ) for every
+    # scenario that got more than max_regression slower than in the baseline
+    regressions = []
+
+    for key, result in results[ 'results' ].iteritems():
+        baseline_result = baseline[ 'results' ].get( key )
+        if baseline_result is None:
+            continue
+
+        baseline_seconds = baseline_result[ 'seconds' ]
+        if baseline_seconds < min_regression_seconds:
+            continue
+
+        if result[ 'seconds' ] > baseline_seconds * ( 1 + max_regression ):
+            regressions.append( ( key, baseline_seconds, result[ 'seconds' ] ) )
+
+    return regressions
+
+def print_results( results, baseline=None ):
+    for key, result in results[ 'results' ].iteritems():
+        line = "{:<24} {:>10.3f}s {:>14.0f} sentences/s".format( key, result[ 'seconds' ], result[ 'sentences_per_second' ] or 0 )
+
+        if baseline is not None and key in baseline[ 'results' ]:
+            baseline_seconds = baseline[ 'results' ][ key ][ 'seconds' ]
+            if baseline_seconds:
+                line += " {:>+8.1%} vs baseline".format( result[ 'seconds' ] / baseline_seconds - 1 )
+
+        print line
+
+def main():
+    parser = argparse.ArgumentParser( description='Benchmark the word count pipeline against a local Solr stand-in' )
+    parser.add_argument( '--sizes', default=','.join( str( size ) for size in default_sizes ),
+                         help='comma separated corpus sizes, in sentences' )
+    parser.add_argument( '--scenarios', default=','.join( scenarios.keys() ),
+                         help='comma separated scenarios to run' )
+    parser.add_argument( '--repeat', type=int, default=3 )
+    parser.add_argument( '--vocabulary-size', type=int, default=50000 )
+    parser.add_argument( '--seed', type=int, default=0 )
+    parser.add_argument( '--pool-size', type=int, default=None )
+    parser.add_argument( '--output', help='write the results as JSON to this file' )
+    parser.add_argument( '--baseline', default=default_baseline_path )
+    parser.add_argument( '--save-baseline', action='store_true', help='store the results as the new baseline' )
+    parser.add_argument( '--max-regression', type=float, default=0.2,
+                         help='fail if a scenario is this much slower than the baseline (0.2 = 20%%)' )
+    args = parser.parse_args()
+
+    sizes = [ int( size ) for size in args.sizes.split( ',' ) if size ]
+
+    scenario_names = [ name for name in args.scenarios.split( ',' ) if name ]
+    for name in scenario_names:
+        if name not in scenarios:
+            parser.error( "unknown scenario '{}'".format( name ) )
+
+    # the corpus is served by the stand-in, so no Solr URLs are configured
+    config = mc_config.read_defaults_config()
+    config[ 'mediawords' ][ 'solr_url' ] = []
+    if args.pool_size is not None:
+        config[ 'word_count' ][ 'pool_size' ] = args.pool_size
+    mc_config.set_config( config )
+
+    word_count_pool.start()
+
+    try:
+        results = run( sizes, scenario_names, args.repeat, args.vocabulary_size, args.seed )
+    finally:
+        word_count_pool.stop()
+
+    if args.output:
+        with open( args.output, 'wb' ) as f:
+            json.dump( results, f, indent=2 )
+
+    if args.save_baseline:
+        with open( args.baseline, 'wb' ) as f:
+            json.dump( results, f, indent=2 )
+
+        print_results( results )
+        print "saved baseline to {}".format( args.baseline )
+        return
+
+    if not os.path.isfile( args.baseline ):
+        print_results( results )
+        print "no baseline at {}, run with --save-baseline to store one".format( args.baseline )
+        return
+
+    with open( args.baseline, 'rb' ) as f:
+        baseline = json.load( f )
+
+    print_results( results, baseline )
+
+    if baseline[ 'parameters' ] != results[ 'parameters' ]:
+        sys.exit( "baseline parameters {} differ from {}, not comparing".format( baseline[ 'parameters' ], results[ 'parameters' ] ) )
+
+    regressions = compare( results, baseline, args.max_regression )
+
+    for key, baseline_seconds, seconds in regressions:
+        print "REGRESSION: {} took {:.3f}s, baseline {:.3f}s".format( key, seconds, baseline_seconds )
+
+    if regressions:
+        sys.exit( 1 )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+
+#
+# Synthetic story sentence corpus for word count benchmarks
+#
+# Sentences are drawn from a made up vocabulary whose term frequencies follow a
+# Zipf-Mandelbrot law, the way the frequencies of words in news text do.  Part
+# of the vocabulary are inflections ("-s", "-ing", "-ed", "-ly") of other
+# terms, so stemming merges terms as it does for real sentences, and some
+# tokens carry a possessive "'s" and some sentences non-ASCII terms.
+#
+# The corpus only depends on its parameters and the seed, so every run of a
+# benchmark counts exactly the same sentences.
+#
+
+import datetime
+
+import numpy as np
+
+_consonants = [ u'b', u'c', u'd', u'f', u'g', u'h', u'k', u'l', u'm', u'n', u'p', u'r', u's', u't', u'v', u'w', u'z', u'ch', u'st', u'tr' ]
+_vowels = [ u'a', u'e', u'i', u'o', u'u', u'ai', u'ou', u'\xe9' ]
+_inflections = [ u's', u'ing', u'ed', u'ly' ]
+
+# Zipf-Mandelbrot parameters: P( rank ) ~ 1 / ( rank + zipf_offset ) ** zipf_exponent
+zipf_exponent = 1.07
+zipf_offset = 2.7
+
+# fraction of the vocabulary that are inflections of other terms
+inflected_fraction = 0.3
+
+# fraction of tokens written with a possessive "'s"
+possessive_fraction = 0.03
+
+min_sentence_words = 4
+max_sentence_words = 36
+
+# sentences of a story and stories of a day
+sentences_per_story = 20
+default_start_date = datetime.datetime( 2013, 4, 1 )
+default_days = 30
+
+def generate_vocabulary( size, random_state ):
+    # Returns size distinct terms in rank order (most frequent first)
+    terms = []
+    seen = set()
+
+    num_base_terms = max( int( size * ( 1 - inflected_fraction ) ), 1 )
+
+    while len( terms ) < num_base_terms:
+        num_syllables = random_state.randint( 1, 4 )
+        term = u''.join(
+            _consonants[ random_state.randint( len( _consonants ) ) ] + _vowels[ random_state.randint( len( _vowels ) ) ]
+            for i in range( num_syllables ) )
+
+        # keep non-ASCII terms rare
+        if u'\xe9' in term and random_state.random_sample() > 0.1:
+            continue
+
+        if term not in seen:
+            seen.add( term )
+            terms.append( term )
+
+    while len( terms ) < size:
+        term = terms[ random_state.randint( num_base_terms ) ] + _inflections[ random_state.randint( len( _inflections ) ) ]
+        if term not in seen:
+            seen.add( term )
+            terms.append( term )
+
+    # mix inflections into the ranks of their base terms
+    random_state.shuffle( terms )
+
+    return terms
+
+def _rank_cdf( vocabulary_size ):
+    weights = 1.0 / ( np.arange( vocabulary_size ) + 1 + zipf_offset ) ** zipf_exponent
+    cdf = np.cumsum( weights )
+
+    return cdf / cdf[ -1 ]
+
+def generate_sentences( num_sentences, vocabulary_size=50000, seed=0 ):
+    # Returns a list of num_sentences unicode sentences
+    random_state = np.random.RandomState( seed )
+
+    vocabulary = generate_vocabulary( vocabulary_size, random_state )
+
+    lengths = random_state.randint( min_sentence_words, max_sentence_words + 1, size=num_sentences )
+    num_tokens = int( lengths.sum() )
+
+    term_ids = np.searchsorted( _rank_cdf( vocabulary_size ), random_state.random_sample( num_tokens ) )
+    possessive = random_state.random_sample( num_tokens ) < possessive_fraction
+
+    tokens = [ vocabulary[ term_id ] for term_id in term_ids.tolist() ]
+    for i in np.flatnonzero( possessive ).tolist():
+        tokens[ i ] += u"'s"
+
+    endings = [ u'.', u'.', u'.', u'?', u'!' ]
+    sentence_endings = random_state.randint( len( endings ), size=num_sentences ).tolist()
+
+    sentences = []
+    start = 0
+    for length, ending in zip( lengths.tolist(), sentence_endings ):
+        words = tokens[ start:start + length ]
+        start += length
+
+        sentence = u' '.join( words )
+        sentences.append( sentence[ 0 ].upper() + sentence[ 1: ] + endings[ ending ] )
+
+    return sentences
+
+def generate_documents( num_sentences, vocabulary_size=50000, seed=0, start_date=None, days=None ):
+    # Returns num_sentences story sentence documents with the fields of the
+    # Solr schema, spread evenly over days days from start_date
+    if start_date is None:
+        start_date = default_start_date
+    if days is None:
+        days = default_days
+
+    sentences = generate_sentences( num_sentences, vocabulary_size, seed )
+
+    num_stories = max( ( num_sentences + sentences_per_story - 1 ) / sentences_per_story, 1 )
+    story_seconds = days * 86400.0 / num_stories
+
+    documents = []
+    for i, sentence in enumerate( sentences ):
+        story = i / sentences_per_story
+        stories_id = story + 1
+        story_sentences_id = i + 1
+
+        publish_date = start_date + datetime.timedelta( seconds=int( story * story_seconds ) / 60 * 60 )
+
+        documents.append( {
+                'solr_id': '{}!{}'.format( stories_id, story_sentences_id ),
+                'stories_id': stories_id,
+                'media_id': story % 100 + 1,
+                'story_sentences_id': str( story_sentences_id ),
+                'processed_stories_id': stories_id,
+                'sentence_number': i % sentences_per_story,
+                'sentence': sentence,
+                'language': 'en',
+                'publish_date': publish_date,
+                'publish_day': publish_date.replace( hour=0, minute=0, second=0, microsecond=0 ),
+                } )
+
+    return documents
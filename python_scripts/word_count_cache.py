@@ -0,0 +1,196 @@
+#!/usr/bin/python
+
+#
+# Bounded in-memory cache for word count results
+#
+# Entries are evicted in least recently used order once either the entry count
+# or the estimated size of the cached values exceeds its limit, and expire
+# ttl seconds after they were stored.  Each entry may carry an info dict (e.g.
+# the index version and date range it was computed for) that invalidate()
+# selects entries by.
+#
+
+import collections
+import re
+import sys
+import threading
+import time
+
+import mc_config
+
+_whitespace_re = re.compile( r'\s+' )
+
+def normalize_query( query ):
+    # Returns unicode; byte strings are taken to be UTF-8
+    if query is None:
+        return u''
+
+    if isinstance( query, str ):
+        query = query.decode( 'utf-8' )
+
+    return _whitespace_re.sub( u' ', query ).strip()
+
+def normalize_filter_queries( fq ):
+    # fq may be a single filter query or a list of them; order and whitespace
+    # don't change the result, so neither should they change the key
+    if fq is None:
+        fq = []
+    elif isinstance( fq, basestring ):
+        fq = [ fq ]
+
+    return sorted( set( filter( None, [ normalize_query( f ) for f in fq ] ) ) )
+
+def make_key( q, fq, engine=None, sample=None ):
+    # Returns the key as a UTF-8 byte string.  Results are cached at the
+    # largest number of words a request may ask for, so the number of words
+    # isn't part of the key.  Normalized filter queries never hold a newline,
+    # so it separates them unambiguously.
+    key = u'q:{}_fq:{}'.format( normalize_query( q ), u'\n'.join( normalize_filter_queries( fq ) ) )
+
+    # results of a forced engine are cached apart from the cost model's pick
+    if engine:
+        key += u'_engine:{}'.format( engine )
+
+    if sample:
+        key += u'_sample:{}'.format( sample )
+
+    return key.encode( 'utf-8' )
+
+def estimate_size( value ):
+    # Rough size in bytes of a value made of lists, tuples, dicts, strings and
+    # numbers, including the objects it references
+    size = sys.getsizeof( value )
+
+    if isinstance( value, dict ):
+        for key, item in value.iteritems():
+            size += estimate_size( key ) + estimate_size( item )
+    elif isinstance( value, ( list, tuple ) ):
+        for item in value:
+            size += estimate_size( item )
+
+    return size
+
+class WordCountCache( object ):
+
+    def __init__( self, max_entries=None, max_bytes=None, ttl=None ):
+        config = mc_config.word_count_config()
+
+        if max_entries is None:
+            max_entries = int( config.get( 'cache_max_entries' ) or 0 )
+        if max_bytes is None:
+            max_bytes = int( config.get( 'cache_max_bytes' ) or 0 )
+        if ttl is None:
+            ttl = int( config.get( 'cache_ttl' ) or 0 )
+
+        # 0 means unlimited
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        # key -> ( value, size, expires_at, info )
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get( self, key ):
+        entry = self.get_entry( key )
+
+        return entry[ 0 ] if entry is not None else None
+
+    def get_entry( self, key ):
+        # Returns ( value, info ) or None
+        with self._lock:
+            entry = self._entries.pop( key, None )
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, size, expires_at, info = entry
+
+            if expires_at is not None and expires_at <= time.time():
+                self._size -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            # reinsert as the most recently used entry
+            self._entries[ key ] = entry
+            self.hits += 1
+
+            return value, info
+
+    def set( self, key, value, info=None ):
+        # info counts towards the size of the entry
+        size = estimate_size( value ) + ( estimate_size( info ) if info is not None else 0 )
+        expires_at = time.time() + self.ttl if self.ttl else None
+
+        with self._lock:
+            old_entry = self._entries.pop( key, None )
+            if old_entry is not None:
+                self._size -= old_entry[ 1 ]
+
+            if self.max_bytes and size > self.max_bytes:
+                return False
+
+            self._entries[ key ] = ( value, size, expires_at, info )
+            self._size += size
+
+            self._evict()
+
+        return True
+
+    def _evict( self ):
+        while self._entries and (
+                ( self.max_entries and len( self._entries ) > self.max_entries ) or
+                ( self.max_bytes and self._size > self.max_bytes ) ):
+            key, ( value, size, expires_at, info ) = self._entries.popitem( last=False )
+            self._size -= size
+            self.evictions += 1
+
+    def delete( self, key ):
+        with self._lock:
+            entry = self._entries.pop( key, None )
+            if entry is not None:
+                self._size -= entry[ 1 ]
+
+            return entry is not None
+
+    def invalidate( self, predicate ):
+        # Drops every entry for which predicate( key, info ) is true; returns
+        # the number of entries dropped
+        with self._lock:
+            keys = [ key for key, entry in self._entries.iteritems() if predicate( key, entry[ 3 ] ) ]
+
+            for key in keys:
+                self._size -= self._entries.pop( key )[ 1 ]
+
+            self.invalidations += len( keys )
+
+        return len( keys )
+
+    def clear( self ):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats( self ):
+        with self._lock:
+            return {
+                'entries': len( self._entries ),
+                'bytes': self._size,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                }
@@ -0,0 +1,251 @@
+#!/usr/bin/python
+
+#
+# Per-day partial word counts for date range queries
+#
+# A publish_date (or publish_day) range filter is split into whole-day segments
+# plus, when the range doesn't start or end on a day boundary, a head and a tail
+# segment.  Unstemmed term counts of every whole day are cached on their own, so
+# a range query only has to count the days (and edges) that aren't cached yet;
+# a 30 day window that slides by one day costs one day of counting.
+#
+# Days that ended less than day_cache_settle_days ago are still receiving
+# sentences and are counted but not cached.  Days that get new sentences later
+# on are invalidated by word_count_index_version.py.
+#
+
+import collections
+import datetime
+import re
+
+from dateutil.relativedelta import relativedelta
+
+import mc_config
+import solr_in_memory_wordcount_stemmed
+import word_count_cache
+import word_count_index_version
+
+_range_re = re.compile( r'^\s*(publish_date|publish_day)\s*:\s*([\[{])\s*(\S+)\s+TO\s+(\S+)\s*([\]}])\s*$' )
+
+_date_re = re.compile( r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?Z((?:[+-]\d+[A-Z]+|/[A-Z]+)*)$' )
+
+_date_math_re = re.compile( r'([+-]\d+|/)([A-Z]+)' )
+
+_date_math_units = {
+    'YEAR': 'years',
+    'MONTH': 'months',
+    'DAY': 'days',
+    'DATE': 'days',
+    'HOUR': 'hours',
+    'MINUTE': 'minutes',
+    'SECOND': 'seconds',
+    }
+
+_one_day = datetime.timedelta( days=1 )
+
+_day_cache = None
+
+def day_cache():
+    global _day_cache
+
+    if _day_cache is None:
+        config = mc_config.word_count_config()
+        _day_cache = word_count_cache.WordCountCache(
+            max_entries=int( config.get( 'day_cache_max_entries' ) or 0 ),
+            max_bytes=int( config.get( 'day_cache_max_bytes' ) or 0 ) )
+
+    return _day_cache
+
+def parse_solr_date( date_str ):
+    # Parses an absolute Solr date with optional date math (e.g.
+    # "2013-04-01T00:00:00.000Z+1MONTH"); returns None for anything else,
+    # including "*" and NOW-relative dates
+    match = _date_re.match( date_str )
+    if not match:
+        return None
+
+    year, month, day, hour, minute, second, fraction, date_math = match.groups()
+
+    microsecond = int( ( fraction or '0' ).ljust( 6, '0' ) )
+    date = datetime.datetime( int( year ), int( month ), int( day ), int( hour ), int( minute ), int( second ), microsecond )
+
+    for operator, unit in _date_math_re.findall( date_math ):
+        if unit.endswith( 'S' ):
+            unit = unit[ :-1 ]
+        if unit not in _date_math_units:
+            return None
+
+        if operator == '/':
+            date = _round_down( date, unit )
+        else:
+            date += relativedelta( **{ _date_math_units[ unit ]: int( operator ) } )
+
+    return date
+
+def _round_down( date, unit ):
+    if unit == 'YEAR':
+        return date.replace( month=1, day=1, hour=0, minute=0, second=0, microsecond=0 )
+    elif unit == 'MONTH':
+        return date.replace( day=1, hour=0, minute=0, second=0, microsecond=0 )
+    elif unit in ( 'DAY', 'DATE' ):
+        return date.replace( hour=0, minute=0, second=0, microsecond=0 )
+    elif unit == 'HOUR':
+        return date.replace( minute=0, second=0, microsecond=0 )
+    elif unit == 'MINUTE':
+        return date.replace( second=0, microsecond=0 )
+    else:
+        return date.replace( microsecond=0 )
+
+def format_solr_date( date ):
+    if date.microsecond:
+        return date.strftime( '%Y-%m-%dT%H:%M:%S' ) + '.{:03d}Z'.format( date.microsecond / 1000 )
+
+    return date.strftime( '%Y-%m-%dT%H:%M:%SZ' )
+
+def _range_filter( field, start, start_inclusive, end, end_inclusive ):
+    return '{}:{}{} TO {}{}'.format(
+        field,
+        '[' if start_inclusive else '{',
+        format_solr_date( start ),
+        format_solr_date( end ),
+        ']' if end_inclusive else '}' )
+
+def _floor_day( date ):
+    return date.replace( hour=0, minute=0, second=0, microsecond=0 )
+
+def split_day_range( fq ):
+    # Returns ( other_fq, segments ) where segments is a list of ( filter, day )
+    # pairs covering the date range filter in fq; day is the start of a whole
+    # day for cacheable segments and None for partial-day edges.  Returns None if
+    # fq has no single absolute date range covering at least one whole day.
+    if fq is None:
+        fq = []
+    elif isinstance( fq, basestring ):
+        fq = [ fq ]
+
+    date_filters = [ f for f in fq if _range_re.match( f ) ]
+    if len( date_filters ) != 1:
+        return None
+
+    other_fq = [ f for f in fq if f is not date_filters[ 0 ] ]
+
+    field, start_bracket, start_str, end_str, end_bracket = _range_re.match( date_filters[ 0 ] ).groups()
+
+    start = parse_solr_date( start_str )
+    end = parse_solr_date( end_str )
+    if start is None or end is None:
+        return None
+
+    start_inclusive = start_bracket == '['
+    end_inclusive = end_bracket == ']'
+
+    # publish_day only holds midnights, so an inclusive end day covers that whole day
+    if field == 'publish_day' and end_inclusive and end == _floor_day( end ):
+        end += _one_day
+        end_inclusive = False
+
+    if start_inclusive and start == _floor_day( start ):
+        first_day = start
+    else:
+        first_day = _floor_day( start ) + _one_day
+
+    last_day_end = _floor_day( end )
+
+    if first_day + _one_day > last_day_end:
+        return None
+
+    segments = []
+
+    if start < first_day:
+        segments.append( ( _range_filter( field, start, start_inclusive, first_day, False ), None ) )
+
+    day = first_day
+    while day + _one_day <= last_day_end:
+        segments.append( ( _range_filter( field, day, True, day + _one_day, False ), day ) )
+        day += _one_day
+
+    if last_day_end < end or end_inclusive:
+        segments.append( ( _range_filter( field, last_day_end, True, end, end_inclusive ), None ) )
+
+    return other_fq, segments
+
+def filter_date_range( fq ):
+    # Returns ( start, end ) bounding the publish dates that the date range
+    # filters in fq let through; either is None if unbounded (or relative to
+    # NOW).  Bounds are treated as inclusive.
+    if fq is None:
+        fq = []
+    elif isinstance( fq, basestring ):
+        fq = [ fq ]
+
+    start = end = None
+
+    for f in fq:
+        match = _range_re.match( f )
+        if not match:
+            continue
+
+        field, start_bracket, start_str, end_str, end_bracket = match.groups()
+
+        filter_start = parse_solr_date( start_str )
+        if filter_start is not None and ( start is None or filter_start > start ):
+            start = filter_start
+
+        filter_end = parse_solr_date( end_str )
+        if filter_end is not None:
+            # publish_day only holds midnights, so an end day covers that whole day
+            if field == 'publish_day':
+                filter_end = _floor_day( filter_end ) + _one_day
+            if end is None or filter_end < end:
+                end = filter_end
+
+    return start, end
+
+def _day_key( q, other_fq, day ):
+    return word_count_cache.make_key( q, other_fq ) + '_day:' + day.strftime( '%Y-%m-%d' )
+
+def _day_is_settled( day ):
+    settle_days = int( mc_config.word_count_config().get( 'day_cache_settle_days' ) or 0 )
+
+    return day + _one_day <= datetime.datetime.utcnow() - datetime.timedelta( days=settle_days )
+
+def get_term_counts( solr, fq, q, segments=None ):
+    # Returns unstemmed term counts for the query, merged from per-day partial
+    # counts; returns None if fq can't be split into days
+    if segments is None:
+        segments = split_day_range( fq )
+        if segments is None:
+            return None
+
+    other_fq, segments = segments
+
+    cache = day_cache()
+    partial_counts = []
+    cached_days = 0
+
+    versions = word_count_index_version.index_versions()
+    version = versions.version
+
+    for segment_filter, day in segments:
+        key = _day_key( q, other_fq, day ) if day is not None else None
+
+        term_counts = cache.get( key ) if key is not None else None
+
+        if term_counts is not None:
+            cached_days += 1
+        else:
+            term_counts = solr_in_memory_wordcount_stemmed.get_term_counts( solr, other_fq + [ segment_filter ], q )
+
+            if key is not None and _day_is_settled( day ) and not versions.changed_since( version, ( day, day + _one_day ) ):
+                cache.set( key, term_counts, info={ 'day': day } )
+
+        partial_counts.append( term_counts )
+
+    print "merged {} segments ({} days from cache)".format( len( segments ), cached_days )
+
+    # merge into a fresh counter so cached day counts are never modified
+    freq = collections.Counter()
+    for term_counts in partial_counts:
+        freq.update( term_counts )
+
+    return freq
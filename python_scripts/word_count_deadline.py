@@ -0,0 +1,74 @@
+#!/usr/bin/python
+
+#
+# Per-request deadlines for word count computations
+#
+# word_count_rest_server.py runs every computation inside deadline( seconds ).
+# The code that fetches and counts pages calls check() between pages and waits
+# for pool results with wait(), so a computation stops with DeadlineExceeded
+# soon after the client's time budget is spent.  Stopping the page loop closes
+# the Solr page generators, which stops prefetching; pages already queued on
+# the worker pool carry the deadline too and are skipped by the workers.
+#
+# Deadlines are per thread; without one nothing ever expires.
+#
+
+import contextlib
+import multiprocessing
+import threading
+import time
+
+class DeadlineExceeded( Exception ):
+    pass
+
+_local = threading.local()
+
+def get():
+    # Absolute deadline (a time.time() value) of the current thread, or None
+    return getattr( _local, 'deadline', None )
+
+@contextlib.contextmanager
+def deadline( seconds ):
+    # Runs the block with a deadline seconds from now; a nested deadline never
+    # extends an outer one
+    outer = get()
+
+    if seconds is None:
+        _local.deadline = outer
+    else:
+        _local.deadline = time.time() + seconds
+        if outer is not None:
+            _local.deadline = min( outer, _local.deadline )
+
+    try:
+        yield
+    finally:
+        _local.deadline = outer
+
+def remaining():
+    # Seconds left before the deadline (never negative), or None
+    current = get()
+    if current is None:
+        return None
+
+    return max( current - time.time(), 0 )
+
+def expired( current=None ):
+    # Whether the given deadline (by default the current thread's) has passed;
+    # pool workers call this with the deadline their task was sent with
+    if current is None:
+        current = get()
+
+    return current is not None and time.time() >= current
+
+def check():
+    if expired():
+        raise DeadlineExceeded( 'request deadline exceeded' )
+
+def wait( async_result ):
+    # async_result.get(), but raises DeadlineExceeded instead of waiting past
+    # the deadline
+    try:
+        return async_result.get( remaining() )
+    except multiprocessing.TimeoutError:
+        raise DeadlineExceeded( 'request deadline exceeded' )
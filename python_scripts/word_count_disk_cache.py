@@ -0,0 +1,349 @@
+#!/usr/bin/python
+
+#
+# Disk-backed second tier of the word count result cache
+#
+# Results are also written to an SQLite database, so that they survive
+# restarts and deploys and are shared by every serving worker on the box.
+# word_count_rest_server.py looks an entry up here when the in-memory cache
+# misses, and on startup loads the hottest entries (by hits) back into memory
+# before the worker takes traffic.
+#
+# Values are stored as zlib-compressed pickles; term counters are packed into
+# a NUL-separated string of terms and an array of 32-bit counts (64-bit if
+# any count needs it) first, which is a third smaller than a pickled dict and
+# quicker to load.  Counters whose terms aren't all text (unicode or ASCII
+# byte strings) or whose counts don't fit an array are pickled as they are.
+# Entries expire ttl seconds after they were stored and the least recently
+# used ones are evicted once the stored size exceeds max_bytes.
+#
+# clear() also bumps a clear generation stored next to the entries, so that
+# every serving worker notices (see clear_generation()) and drops its
+# in-memory caches too.
+#
+# Every process opens its own connection (SQLite connections don't survive a
+# fork); the database is in WAL mode so that readers don't block the writer.
+# Errors are logged and treated as misses: the disk tier never fails a
+# request.
+#
+
+import array
+import collections
+import cPickle
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+import mc_config
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    stored_at REAL NOT NULL,
+    accessed_at REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+)
+'''
+
+# A single row counting the calls to clear()
+_clears_schema = '''
+CREATE TABLE IF NOT EXISTS clears (
+    id INTEGER PRIMARY KEY CHECK ( id = 0 ),
+    generation INTEGER NOT NULL
+)
+'''
+
+class _PackedCounter( object ):
+    # A collections.Counter of text terms as two flat strings; raises
+    # UnicodeDecodeError for non-ASCII byte string terms (which wouldn't come
+    # back as equal keys) and OverflowError for counts that don't fit
+
+    # of counters packed before the type was chosen per counter
+    count_type = 'I'
+
+    def __init__( self, counter ):
+        terms = counter.keys()
+        counts = [ counter[ term ] for term in terms ]
+
+        # ASCII byte strings come back as equal (and equally hashed) unicode
+        text_terms = [ term.decode( 'ascii' ) if isinstance( term, str ) else term for term in terms ]
+
+        self.count_type = 'I' if not counts or max( counts ) < 2 ** 32 else 'L'
+
+        self.terms = u'\0'.join( text_terms ).encode( 'utf-8' )
+        self.counts = array.array( self.count_type, counts ).tostring()
+
+    def unpack( self ):
+        counts = array.array( self.count_type )
+        counts.fromstring( self.counts )
+
+        terms = self.terms.decode( 'utf-8' ).split( u'\0' ) if counts else []
+
+        return collections.Counter( dict( zip( terms, counts ) ) )
+
+def _pack( value ):
+    if isinstance( value, collections.Counter ):
+        try:
+            return _PackedCounter( value )
+        except ( UnicodeDecodeError, OverflowError, TypeError ):
+            return value
+    if isinstance( value, dict ):
+        return dict( ( key, _pack( item ) ) for key, item in value.iteritems() )
+
+    return value
+
+def _unpack( value ):
+    if isinstance( value, _PackedCounter ):
+        return value.unpack()
+    if isinstance( value, dict ):
+        return dict( ( key, _unpack( item ) ) for key, item in value.iteritems() )
+
+    return value
+
+def encode( value, info=None ):
+    return zlib.compress( cPickle.dumps( ( _pack( value ), _pack( info ) ), cPickle.HIGHEST_PROTOCOL ) )
+
+def decode( data ):
+    # Returns ( value, info )
+    value, info = cPickle.loads( zlib.decompress( str( data ) ) )
+
+    return _unpack( value ), _unpack( info )
+
+def _text( key ):
+    # Keys are UTF-8 byte strings, but SQLite only takes text as unicode
+    return key.decode( 'utf-8' ) if isinstance( key, str ) else key
+
+def default_path():
+    # disk_cache_path, relative to the root of the repository; None if the
+    # disk tier is disabled
+    path = mc_config.word_count_config().get( 'disk_cache_path' )
+    if not path:
+        return None
+
+    return os.path.abspath( os.path.join( os.path.dirname( __file__ ), '..', path ) )
+
+class DiskCache( object ):
+
+    def __init__( self, path=None, max_bytes=None, ttl=None ):
+        config = mc_config.word_count_config()
+
+        if path is None:
+            path = default_path()
+        if max_bytes is None:
+            max_bytes = int( config.get( 'disk_cache_max_bytes' ) or 0 )
+        if ttl is None:
+            ttl = int( config.get( 'cache_ttl' ) or 0 )
+
+        # None disables the cache; 0 means unlimited
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.errors = 0
+
+    @property
+    def enabled( self ):
+        return self.path is not None
+
+    def _connect( self ):
+        # The connection of this process; called with _lock held
+        if self._connection is None or self._pid != os.getpid():
+            directory = os.path.dirname( self.path )
+            if directory and not os.path.isdir( directory ):
+                os.makedirs( directory )
+
+            connection = sqlite3.connect( self.path, timeout=30, check_same_thread=False, isolation_level=None )
+            connection.execute( 'PRAGMA journal_mode=WAL' )
+            connection.execute( 'PRAGMA synchronous=NORMAL' )
+            connection.execute( _schema )
+            connection.execute( _clears_schema )
+            connection.execute( 'CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries ( accessed_at )' )
+
+            self._connection = connection
+            self._pid = os.getpid()
+
+        return self._connection
+
+    def _error( self, action, e ):
+        self.errors += 1
+        sys.stderr.write( 'word count disk cache {0} failed: {1}\n'.format( action, e ) )
+
+    def get( self, key, touch=True ):
+        # Returns ( value, info ) or None; touch=False doesn't count the lookup
+        # as a hit (e.g. when preloading)
+        if not self.enabled:
+            return None
+
+        try:
+            with self._lock:
+                connection = self._connect()
+
+                row = connection.execute( 'SELECT data, stored_at FROM entries WHERE key = ?', ( _text( key ), ) ).fetchone()
+
+                if row is not None and self.ttl and row[ 1 ] + self.ttl <= time.time():
+                    connection.execute( 'DELETE FROM entries WHERE key = ?', ( _text( key ), ) )
+                    row = None
+
+                if row is None:
+                    self.misses += 1
+                    return None
+
+                if touch:
+                    connection.execute( 'UPDATE entries SET accessed_at = ?, hits = hits + 1 WHERE key = ?', ( time.time(), _text( key ) ) )
+                    self.hits += 1
+
+            return decode( row[ 0 ] )
+        except Exception, e:
+            self._error( 'read', e )
+            return None
+
+    def set( self, key, value, info=None ):
+        if not self.enabled:
+            return False
+
+        try:
+            data = encode( value, info )
+        except Exception, e:
+            self._error( 'encode', e )
+            return False
+
+        if self.max_bytes and len( data ) > self.max_bytes:
+            return False
+
+        try:
+            with self._lock:
+                connection = self._connect()
+
+                now = time.time()
+                connection.execute( 'INSERT OR REPLACE INTO entries ( key, data, size, stored_at, accessed_at, hits ) VALUES '
+                                    '( ?, ?, ?, ?, ?, COALESCE( ( SELECT hits FROM entries WHERE key = ? ), 0 ) )',
+                                    ( _text( key ), sqlite3.Binary( data ), len( data ), now, now, _text( key ) ) )
+                self.writes += 1
+
+                self._evict( connection )
+
+            return True
+        except Exception, e:
+            self._error( 'write', e )
+            return False
+
+    def _evict( self, connection ):
+        if not self.max_bytes:
+            return
+
+        size = connection.execute( 'SELECT COALESCE( SUM( size ), 0 ) FROM entries' ).fetchone()[ 0 ]
+
+        while size > self.max_bytes:
+            rows = connection.execute( 'SELECT key, size FROM entries ORDER BY accessed_at LIMIT 100' ).fetchall()
+            if not rows:
+                break
+
+            for key, entry_size in rows:
+                if size <= self.max_bytes:
+                    break
+
+                connection.execute( 'DELETE FROM entries WHERE key = ?', ( _text( key ), ) )
+                size -= entry_size
+                self.evictions += 1
+
+    def delete( self, key ):
+        if not self.enabled:
+            return False
+
+        try:
+            with self._lock:
+                return self._connect().execute( 'DELETE FROM entries WHERE key = ?', ( _text( key ), ) ).rowcount > 0
+        except Exception, e:
+            self._error( 'delete', e )
+            return False
+
+    def hottest( self, num_entries ):
+        # Keys of the num_entries unexpired entries with the most hits
+        if not self.enabled:
+            return []
+
+        min_stored_at = time.time() - self.ttl if self.ttl else 0
+
+        try:
+            with self._lock:
+                rows = self._connect().execute( 'SELECT key FROM entries WHERE stored_at > ? ORDER BY hits DESC, accessed_at DESC LIMIT ?',
+                                                ( min_stored_at, num_entries ) ).fetchall()
+
+            return [ row[ 0 ].encode( 'utf-8' ) for row in rows ]
+        except Exception, e:
+            self._error( 'read', e )
+            return []
+
+    def clear( self ):
+        # Deletes every entry and bumps the clear generation
+        if not self.enabled:
+            return
+
+        try:
+            with self._lock:
+                connection = self._connect()
+
+                connection.execute( 'BEGIN IMMEDIATE' )
+                try:
+                    connection.execute( 'DELETE FROM entries' )
+                    connection.execute( 'INSERT OR REPLACE INTO clears ( id, generation ) VALUES '
+                                        '( 0, COALESCE( ( SELECT generation FROM clears WHERE id = 0 ), 0 ) + 1 )' )
+                    connection.execute( 'COMMIT' )
+                except:
+                    connection.execute( 'ROLLBACK' )
+                    raise
+        except Exception, e:
+            self._error( 'clear', e )
+
+    def clear_generation( self ):
+        # Number of times any process cleared the cache, or None if the disk
+        # tier is disabled or can't be read
+        if not self.enabled:
+            return None
+
+        try:
+            with self._lock:
+                row = self._connect().execute( 'SELECT generation FROM clears WHERE id = 0' ).fetchone()
+
+            return row[ 0 ] if row is not None else 0
+        except Exception, e:
+            self._error( 'read', e )
+            return None
+
+    def stats( self ):
+        stats = {
+            'path': self.path,
+            'max_bytes': self.max_bytes,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'evictions': self.evictions,
+            'errors': self.errors,
+            'entries': 0,
+            'bytes': 0,
+            'clear_generation': self.clear_generation(),
+            }
+
+        if self.enabled:
+            try:
+                with self._lock:
+                    stats[ 'entries' ], stats[ 'bytes' ] = self._connect().execute(
+                        'SELECT COUNT(*), COALESCE( SUM( size ), 0 ) FROM entries' ).fetchone()
+            except Exception, e:
+                self._error( 'read', e )
+
+        return stats
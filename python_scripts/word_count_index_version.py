@@ -0,0 +1,217 @@
+#!/usr/bin/python
+
+#
+# Index-version-aware invalidation of cached word counts
+#
+# Solr's own index version is per core, so the service tracks a generation of
+# the whole collection instead: its number of sentences and its highest
+# processed_stories_id.  Every new generation seen gets the next local index
+# version, and cached results are tagged with the version they were computed
+# at and the publish date range of their filters.
+#
+# When the generation changes, a facet query finds the publish days of the
+# sentences above the previous highest processed_stories_id, and only cached
+# results whose date range overlaps one of those days are invalidated, so the
+# cache stays mostly warm across imports.  If the number of sentences changed
+# by anything but those new sentences (i.e. sentences were deleted), nothing
+# tells which days changed and every cached result is invalidated.
+#
+# The index is checked at most once every index_check_seconds.
+#
+# Local versions start over with every process, so results kept across
+# restarts (see word_count_disk_cache.py) are tagged with the generation
+# instead, and changes_since_generation() tells which days changed since.
+#
+
+import collections
+import datetime
+import sys
+import threading
+import time
+
+import mc_config
+
+_one_day = datetime.timedelta( days=1 )
+
+# changes remembered by changed_since(); results computed before the oldest
+# one are treated as changed
+max_changes = 1000
+
+def overlaps( date_range, days ):
+    # Whether a ( start, end ) publish date range (either end may be None)
+    # overlaps any of the days (a set of midnights); days None means every day
+    if days is None:
+        return True
+
+    start, end = date_range
+
+    for day in days:
+        if ( start is None or start < day + _one_day ) and ( end is None or end >= day ):
+            return True
+
+    return False
+
+class IndexVersions( object ):
+
+    def __init__( self, check_seconds=None ):
+        if check_seconds is None:
+            check_seconds = float( mc_config.word_count_config().get( 'index_check_seconds' ) or 0 )
+
+        self.check_seconds = check_seconds
+
+        # local index version; 0 until the index has been looked at
+        self.version = 0
+        self.generation = None
+
+        # ( version, set of changed days or None for every day ), oldest first
+        self._changes = collections.deque( maxlen=max_changes )
+
+        self._last_check = None
+
+        # ( version, older generation ) -> changed days, for
+        # changes_since_generation()
+        self._generation_changes = {}
+
+        self._lock = threading.Lock()
+        self._check_lock = threading.Lock()
+
+    def _read_generation( self, solr ):
+        results = solr.search( '*:*', rows=1, fl='processed_stories_id', sort='processed_stories_id desc' )
+
+        max_processed_stories_id = int( results.docs[ 0 ][ 'processed_stories_id' ] ) if results.docs else 0
+
+        return results.hits, max_processed_stories_id
+
+    def _new_days( self, solr, processed_stories_id, max_processed_stories_id=None ):
+        # Returns the number of sentences above processed_stories_id (up to
+        # max_processed_stories_id, if given) and the set of their publish days
+        results = solr.search( 'processed_stories_id:{{{0} TO {1}]'.format(
+                processed_stories_id, '*' if max_processed_stories_id is None else max_processed_stories_id ), **{
+                'rows': 0,
+                'facet': 'true',
+                'facet.field': 'publish_day',
+                'facet.limit': -1,
+                'facet.mincount': 1,
+                } )
+
+        facets = results.facets[ 'facet_fields' ][ 'publish_day' ]
+
+        days = set()
+        for day_str in facets[ 0::2 ]:
+            # facet values are dates like "2013-04-01T00:00:00Z"
+            day = datetime.datetime.strptime( day_str[ :10 ], '%Y-%m-%d' )
+            days.add( day )
+
+        return results.hits, days
+
+    def check( self, solr ):
+        # Looks for a new generation of the index (unless it was checked less
+        # than check_seconds ago or another thread is checking right now);
+        # returns ( version, changed days or None ) for a new generation,
+        # otherwise None
+        if not self._check_lock.acquire( False ):
+            return None
+
+        try:
+            if self._last_check is not None and time.time() - self._last_check < self.check_seconds:
+                return None
+
+            self._last_check = time.time()
+
+            generation = self._read_generation( solr )
+
+            if generation == self.generation:
+                return None
+
+            if self.generation is None:
+                # first look: nothing was cached for an older generation
+                days = set()
+            else:
+                num_sentences, max_processed_stories_id = self.generation
+
+                num_new_sentences, days = self._new_days( solr, max_processed_stories_id )
+
+                if generation[ 0 ] != num_sentences + num_new_sentences:
+                    days = None
+
+            with self._lock:
+                self.generation = generation
+                self.version += 1
+                self._changes.append( ( self.version, days ) )
+
+                version = self.version
+
+            sys.stderr.write( 'Solr index version {0} (generation {1}): {2} changed\n'.format(
+                    version, generation, 'every day' if days is None else '{0} days'.format( len( days ) ) ) )
+
+            return version, days
+        finally:
+            self._check_lock.release()
+
+    def current( self ):
+        # Returns ( version, generation ) as of the last check
+        with self._lock:
+            return self.version, self.generation
+
+    def changed_since( self, version, date_range ):
+        # Whether a result for date_range computed at index version version
+        # could have been changed by a later generation
+        with self._lock:
+            if version >= self.version:
+                return False
+
+            if not self._changes or self._changes[ 0 ][ 0 ] > version + 1:
+                return True
+
+            return any( overlaps( date_range, days ) for change_version, days in self._changes if change_version > version )
+
+    def changes_since_generation( self, solr, generation ):
+        # The set of publish days changed between an older generation and the
+        # current one, or None for every day (sentences were deleted, or the
+        # index hasn't been looked at yet)
+        version, current = self.current()
+
+        if current is None:
+            return None
+        if generation == current:
+            return set()
+
+        generation = tuple( generation )
+
+        with self._lock:
+            if ( version, generation ) in self._generation_changes:
+                return self._generation_changes[ ( version, generation ) ]
+
+        num_sentences, max_processed_stories_id = generation
+
+        # sentences indexed after the last check don't count against the
+        # current generation
+        num_new_sentences, days = self._new_days( solr, max_processed_stories_id, current[ 1 ] )
+
+        if current[ 0 ] != num_sentences + num_new_sentences:
+            days = None
+
+        with self._lock:
+            # only the current version's answers are worth keeping
+            self._generation_changes = dict( ( key, value ) for key, value in self._generation_changes.iteritems() if key[ 0 ] == version )
+            self._generation_changes[ ( version, generation ) ] = days
+
+        return days
+
+    def stats( self ):
+        with self._lock:
+            return {
+                'version': self.version,
+                'generation': self.generation,
+                'last_check': self._last_check,
+                }
+
+_index_versions = None
+
+def index_versions():
+    global _index_versions
+
+    if _index_versions is None:
+        _index_versions = IndexVersions()
+
+    return _index_versions
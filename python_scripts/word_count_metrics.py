@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+#
+# Stage timers, histograms and counters for the word count pipeline
+#
+# Metrics are kept in process and rendered in the Prometheus text exposition
+# format by word_count_rest_server.py's /metrics endpoint.
+#
+
+import contextlib
+import threading
+import time
+
+_stage_buckets = ( 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250 )
+
+_size_buckets = ( 10, 100, 1000, 10000, 100000, 1000000, 10000000, 100000000 )
+
+# name -> ( help, buckets )
+histograms = {
+    'word_count_stage_seconds': ( 'Time spent in each stage of the word count pipeline', _stage_buckets ),
+    'word_count_matching_documents': ( 'Sentences matching a word count query', _size_buckets ),
+    'word_count_sentences': ( 'Sentences fetched and counted by the in-memory engines', _size_buckets ),
+    'word_count_vocabulary_size': ( 'Distinct terms counted by the in-memory engines', _size_buckets ),
+    }
+
+# name -> help
+counters = {
+    'word_count_requests_total': 'Word count computations by engine',
+    }
+
+_lock = threading.Lock()
+
+# ( name, labels ) -> [ bucket counts..., sum, count ]
+_histogram_values = {}
+
+# ( name, labels ) -> value
+_counter_values = {}
+
+def _labels_key( labels ):
+    return tuple( sorted( ( labels or {} ).items() ) )
+
+def observe( name, value, **labels ):
+    buckets = histograms[ name ][ 1 ]
+    key = ( name, _labels_key( labels ) )
+
+    with _lock:
+        values = _histogram_values.get( key )
+        if values is None:
+            values = _histogram_values[ key ] = [ 0 ] * ( len( buckets ) + 2 )
+
+        for i, bound in enumerate( buckets ):
+            if value <= bound:
+                values[ i ] += 1
+
+        values[ -2 ] += value
+        values[ -1 ] += 1
+
+def increment( name, value=1, **labels ):
+    key = ( name, _labels_key( labels ) )
+
+    with _lock:
+        _counter_values[ key ] = _counter_values.get( key, 0 ) + value
+
+@contextlib.contextmanager
+def stage_timer( stage ):
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        observe( 'word_count_stage_seconds', time.time() - start_time, stage=stage )
+
+def timed_iterator( iterator, stage ):
+    # Yields the items of iterator, timing each wait for the next item as stage
+    iterator = iter( iterator )
+    while True:
+        with stage_timer( stage ):
+            try:
+                item = next( iterator )
+            except StopIteration:
+                return
+
+        yield item
+
+def _format_labels( labels ):
+    if not labels:
+        return ''
+
+    return '{' + ','.join( '{}="{}"'.format( name, str( value ).replace( '\\', '\\\\' ).replace( '"', '\\"' ) ) for name, value in labels ) + '}'
+
+def _format_value( value ):
+    if isinstance( value, float ):
+        return repr( value )
+
+    return str( value )
+
+def render( extra_metrics=(), labels=None ):
+    # Returns every metric in the Prometheus text format; extra_metrics is a list
+    # of ( name, type, help, [ ( labels dict, value ), ... ] ) tuples collected by
+    # the caller, e.g. cache statistics, and labels are added to every sample
+    # (e.g. the serving worker they were collected by)
+    lines = []
+
+    common_labels = _labels_key( labels )
+
+    with _lock:
+        histogram_values = dict( ( key, list( values ) ) for key, values in _histogram_values.iteritems() )
+        counter_values = dict( _counter_values )
+
+    for name in sorted( histograms.keys() ):
+        help, buckets = histograms[ name ]
+        lines.append( '# HELP {} {}'.format( name, help ) )
+        lines.append( '# TYPE {} histogram'.format( name ) )
+
+        for ( value_name, labels ), values in sorted( histogram_values.iteritems() ):
+            if value_name != name:
+                continue
+
+            for bound, bucket_count in zip( buckets, values ):
+                lines.append( '{}_bucket{} {}'.format( name, _format_labels( labels + common_labels + ( ( 'le', bound ), ) ), bucket_count ) )
+
+            lines.append( '{}_bucket{} {}'.format( name, _format_labels( labels + common_labels + ( ( 'le', '+Inf' ), ) ), values[ -1 ] ) )
+            lines.append( '{}_sum{} {}'.format( name, _format_labels( labels + common_labels ), _format_value( values[ -2 ] ) ) )
+            lines.append( '{}_count{} {}'.format( name, _format_labels( labels + common_labels ), values[ -1 ] ) )
+
+    for name in sorted( counters.keys() ):
+        lines.append( '# HELP {} {}'.format( name, counters[ name ] ) )
+        lines.append( '# TYPE {} counter'.format( name ) )
+
+        for ( value_name, labels ), value in sorted( counter_values.iteritems() ):
+            if value_name == name:
+                lines.append( '{}{} {}'.format( name, _format_labels( labels + common_labels ), _format_value( value ) ) )
+
+    for name, metric_type, help, samples in extra_metrics:
+        lines.append( '# HELP {} {}'.format( name, help ) )
+        lines.append( '# TYPE {} {}'.format( name, metric_type ) )
+
+        for sample_labels, value in samples:
+            lines.append( '{}{} {}'.format( name, _format_labels( _labels_key( sample_labels ) + common_labels ), _format_value( value ) ) )
+
+    return '\n'.join( lines ) + '\n'
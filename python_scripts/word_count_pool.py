@@ -0,0 +1,108 @@
+#!/usr/bin/python
+
+#
+# Long-lived multiprocessing pool shared by every word count request
+#
+# The pool is created once (at service startup, or lazily on first use in batch
+# scripts) instead of forking new workers for every query.  Workers are recycled
+# after pool_max_tasks_per_child tasks so that memory leaked by a worker is
+# returned periodically.
+#
+
+import multiprocessing
+import os
+import threading
+import time
+
+import mc_config
+
+_pool = None
+_pool_size = None
+_pool_started = None
+_pool_lock = threading.Lock()
+
+def _configured_pool_size():
+    pool_size = int( mc_config.word_count_config().get( 'pool_size' ) or 0 )
+    if pool_size <= 0:
+        pool_size = multiprocessing.cpu_count()
+
+    return pool_size
+
+def start( pool_size=None, max_tasks_per_child=None ):
+    # Creates the shared pool; call before the service starts handling requests
+    # so that workers are forked from a process that already has every heavy
+    # module imported
+    global _pool, _pool_size, _pool_started
+
+    with _pool_lock:
+        if _pool is not None:
+            return _pool
+
+        config = mc_config.word_count_config()
+
+        if pool_size is None:
+            pool_size = _configured_pool_size()
+        if max_tasks_per_child is None:
+            max_tasks_per_child = int( config.get( 'pool_max_tasks_per_child' ) or 0 ) or None
+
+        print "starting word count pool with {} workers (max tasks per child: {})".format( pool_size, max_tasks_per_child )
+
+        _pool = multiprocessing.Pool( pool_size, maxtasksperchild=max_tasks_per_child )
+        _pool_size = pool_size
+        _pool_started = time.time()
+
+        return _pool
+
+def stop():
+    global _pool, _pool_size, _pool_started
+
+    with _pool_lock:
+        if _pool is None:
+            return
+
+        _pool.close()
+        _pool.join()
+
+        _pool = None
+        _pool_size = None
+        _pool_started = None
+
+def get_pool():
+    if _pool is None:
+        return start()
+
+    return _pool
+
+def pool_size():
+    get_pool()
+    return _pool_size
+
+def max_tasks_in_flight():
+    # Number of tasks a single request may have queued at once.  The pool's task
+    # queue is FIFO, so capping every request at the pool size makes concurrent
+    # requests take turns on the workers instead of one query queueing all of its
+    # pages ahead of everybody else's.
+    return pool_size()
+
+def health_check( timeout=None ):
+    if timeout is None:
+        timeout = float( mc_config.word_count_config().get( 'pool_health_check_timeout' ) or 10 )
+
+    if _pool is None:
+        return { 'healthy': False, 'error': 'pool not started' }
+
+    start_time = time.time()
+    try:
+        worker_pid = _pool.apply_async( os.getpid ).get( timeout )
+    except multiprocessing.TimeoutError:
+        return { 'healthy': False, 'error': 'no worker answered within {} seconds'.format( timeout ) }
+    except Exception, e:
+        return { 'healthy': False, 'error': str( e ) }
+
+    return {
+        'healthy': True,
+        'pool_size': _pool_size,
+        'worker_pid': worker_pid,
+        'response_time': time.time() - start_time,
+        'uptime': time.time() - _pool_started,
+        }
@@ -1,7 +1,61 @@
 #!/usr/bin/python
 
-from flask import Flask, jsonify, request
+#
+# Word count service
+#
+# Run without arguments for Flask's development server.  In production run
+#
+#   word_count_rest_server.py --production
+#
+# which serves the app with gunicorn: the master imports every heavy module,
+# loads the stem dictionary and creates the Solr connection once, then forks
+# server_workers workers that share that memory copy-on-write and each answer
+# server_threads requests at once.  Every worker starts its own word count
+# pool after the fork (threads don't survive a fork), so pool_size, the
+# in-memory caches and admission control apply per worker: the box runs up to
+# server_workers * max_concurrent_requests computations at once and queues up
+# to server_workers * max_queued_requests more.
+#
+# /cache_stats, /metrics and /health are answered by whichever worker gets the
+# request and describe that worker only; every /metrics sample carries a
+# "worker" label with its process ID so that scrapes of different workers
+# don't get mixed up (sum over it for the whole box).  /clear_cache clears the
+# disk cache and bumps its clear generation, which every worker checks before
+# looking a result up and then drops its in-memory caches too; without the
+# disk tier it has the master replace the workers instead, as SIGHUP does.
+#
+# Results are also kept in the on-disk cache (see word_count_disk_cache.py),
+# which all workers share and which survives restarts: a result missing from
+# a worker's memory is looked up there, and every worker (or the development
+# server) loads the disk_cache_preload_entries hottest ones into memory before
+# it takes requests.
+#
+# Send the master SIGHUP to replace the workers gracefully (with fresh caches
+# and pools), SIGTTIN / SIGTTOU to add or remove a worker and SIGTERM to let
+# in-flight requests finish (for up to request_timeout seconds) and stop.  New
+# code and configuration are only picked up by a new master.
+#
+
+import argparse
+import datetime
+import multiprocessing
+import os
+import signal
+
+from flask import Flask, Response, jsonify, request
+import mc_config
+import mc_solr
 import solr_query_wordcount_timer
+import word_count_admission
+import word_count_cache
+import word_count_days
+import word_count_deadline
+import word_count_disk_cache
+import word_count_index_version
+import word_count_metrics
+import word_count_pool
+import word_count_single_flight
+import word_count_stemmer
 import ipdb
 
 app = Flask(__name__)
@@ -20,47 +74,513 @@ def word_count():
     if not num_words:
         num_words = 500
 
-    print "num_words: {0} q={1} fq={2}".format( num_words, q, fq )
+    try:
+        num_words = max( min( int( num_words ), solr_query_wordcount_timer.max_num_words ), 0 )
+    except ValueError:
+        return error_response( 400, u"invalid nw '{}'".format( num_words ) )
+
+    # optional; "in_memory", "in_solr", "top_k" or "term_vectors" to override the engine picked by the cost model
+    engine = request.args.get( 'engine' ) or None
+    if engine is not None and engine not in solr_query_wordcount_timer.engines:
+        return error_response( 400, u"unknown word count engine '{}'".format( engine ) )
+
+    # optional; "auto" or a number of sentences to count an approximate sample
+    sample = request.args.get( 'sample' ) or None
+    if not solr_query_wordcount_timer.valid_sample( sample ):
+        return error_response( 400, u"invalid sample '{}'".format( sample ) )
+
+    # optional; "interactive" (the default) or "batch"
+    priority = request.args.get( 'priority' ) or None
+    if priority is not None and priority not in word_count_admission.priorities:
+        return error_response( 400, u"unknown priority class '{}'".format( priority ) )
+
+    # optional; seconds the client is willing to wait, at most request_timeout
+    timeout = request_timeout( request.args.get( 'timeout' ) )
+
+    print u"num_words: {0} q={1} fq={2} engine={3} sample={4}".format( num_words, q, fq, engine, sample ).encode( 'utf-8' )
 
-    key = get_key( q, fq, num_words )
+    # results are computed for max_num_words words and cut down to num_words,
+    # so every nw shares one cache entry
+    key = get_key( q, fq, engine, sample )
 
-    ret = fetch_from_cache( key )
+    apply_cache_clears()
+    apply_index_changes()
 
-    if ret:
+    entry = lookup( key )
+
+    if entry is not None and not needs_refresh( entry[ 1 ] ):
         print "Returning from cache with key '{}'".format( key  )
-        return ret
+        ret = entry[ 0 ]
     else:
-        ret = solr_query_wordcount_timer.get_word_counts_for_service( solr, fq, num_words, q )
+        if entry is not None:
+            compute = lambda: refresh_word_counts( key, q, fq, entry[ 1 ], priority )
+        else:
+            compute = lambda: compute_word_counts( key, q, fq, engine, sample, priority )
 
-        ret = jsonify( { 'counts': ret } )
+        try:
+            with word_count_deadline.deadline( timeout ):
+                # identical requests arriving while this one is computed wait for its result
+                ret = single_flight.do( key, compute )
+        except word_count_admission.Rejected, e:
+            ret = error_response( 503, str( e ) )
+            ret.headers[ 'Retry-After' ] = str( int( admission.max_queue_seconds or 1 ) )
+            return ret
+        except word_count_deadline.DeadlineExceeded, e:
+            return error_response( 504, str( e ) )
 
-        store_in_cache( key, ret )
+    return jsonify( dict( ret, counts=ret[ 'counts' ][ :num_words ] ) )
 
-        return ret
+def compute_word_counts( key, q, fq, engine, sample, priority=None ):
+    # Cheap cache hits never get here; everything else waits for one of the
+    # admission controller's slots
+    with admission.admit( priority ):
+        word_count_deadline.check()
 
-cache = {}
+        versions = word_count_index_version.index_versions()
+        version, generation = versions.current()
+        date_range = word_count_days.filter_date_range( fq )
 
-def get_key( q, fq, num_words ):
-    return "q:{}_fq:{}_num_words:{}".format( q, fq, num_words )
+        info = { 'version': version, 'generation': generation, 'date_range': date_range }
 
-def fetch_from_cache( key ) :
-    if key in cache:
-        return cache[ key ]
-    else:
+        if generation is not None and sample is None and keeps_term_counts( date_range ):
+            # an exact engine counts the sentences up to the highest
+            # processed_stories_id seen so far and keeps their term counts, so
+            # that the sentences above it can be added later on
+            watermark = generation[ 1 ]
+            ret = solr_query_wordcount_timer.get_word_counts_for_service(
+                solr, fq, solr_query_wordcount_timer.max_num_words, q, engine, sample, watermark=watermark )
+
+            term_counts = ret.pop( 'term_counts', None )
+            if term_counts is not None:
+                info.update( { 'watermark': watermark, 'engine': ret[ 'engine' ], 'term_counts': term_counts } )
+        else:
+            ret = solr_query_wordcount_timer.get_word_counts_for_service( solr, fq, solr_query_wordcount_timer.max_num_words, q, engine, sample )
+
+    # don't cache a result that a newer index generation already made stale
+    if not versions.changed_since( version, date_range ):
+        store( key, ret, info )
+
+    return ret
+
+def refresh_word_counts( key, q, fq, info, priority=None ):
+    # Adds the sentences indexed above a cached result's processed_stories_id
+    # watermark to its term counts
+    with admission.admit( priority ):
+        word_count_deadline.check()
+
+        versions = word_count_index_version.index_versions()
+        version, generation = versions.current()
+        watermark = generation[ 1 ]
+
+        print "refreshing '{}' with the sentences above processed_stories_id {}".format( key, info[ 'watermark' ] )
+
+        ret, term_counts = solr_query_wordcount_timer.refresh_word_counts(
+            solr, fq + [ solr_query_wordcount_timer.watermark_filter( info[ 'watermark' ], watermark ) ], solr_query_wordcount_timer.max_num_words, q,
+            info[ 'engine' ], info[ 'term_counts' ] )
+
+    if not versions.changed_since( version, info[ 'date_range' ] ):
+        store( key, ret, dict( info, version=version, generation=generation, watermark=watermark, term_counts=term_counts ) )
+
+    return ret
+
+def keeps_term_counts( date_range ):
+    # Term counts are kept for results whose date range is still receiving
+    # sentences, i.e. ends after the days that count as settled
+    if str( mc_config.word_count_config().get( 'incremental_refresh' ) or 'no' ).lower() not in ( 'yes', 'true', '1' ):
+        return False
+
+    settle_days = int( mc_config.word_count_config().get( 'day_cache_settle_days' ) or 0 )
+
+    end = date_range[ 1 ]
+
+    return end is None or end > datetime.datetime.utcnow() - datetime.timedelta( days=settle_days + 1 )
+
+def needs_refresh( info ):
+    # Whether a cached result has term counts and sentences were indexed
+    # since for its date range
+    if not info or info.get( 'term_counts' ) is None:
+        return False
+
+    return word_count_index_version.index_versions().changed_since( info[ 'version' ], info[ 'date_range' ] )
+
+def lookup( key ):
+    # Returns ( value, info ) from the in-memory cache or, failing that, from
+    # the disk cache
+    entry = cache.get_entry( key )
+
+    if entry is None:
+        entry = load_from_disk( key )
+
+    return entry
+
+def store( key, ret, info ):
+    cache.set( key, ret, info=info )
+
+    # results of an index that hasn't been looked at can't be checked later on
+    if info.get( 'generation' ) is not None:
+        disk_cache.set( key, ret, info )
+
+def load_from_disk( key, touch=True ):
+    # Moves a result from the disk cache into memory, if it is still valid for
+    # the current index; returns ( value, info ) or None
+    entry = disk_cache.get( key, touch=touch )
+    if entry is None:
         return None
 
-def store_in_cache( key, value ):
-    cache[key] = value
+    ret, info = entry
+
+    info, stale = revalidate( info )
+    if info is None:
+        # a result that can't be checked right now stays on disk
+        if stale:
+            disk_cache.delete( key )
+        return None
+
+    cache.set( key, ret, info=info )
+
+    return ret, info
+
+def revalidate( info ):
+    # Tags a result stored on disk (possibly by an earlier process) with the
+    # current local index version.  Returns ( info, stale ): info is None if
+    # the result can't be used now, and stale is true only if sentences
+    # indexed (or deleted) since it was stored changed it and it can't be
+    # refreshed.  Results are left alone while the index can't be checked and
+    # when another worker stored them for a newer generation than this one
+    # has seen.
+    versions = word_count_index_version.index_versions()
+    version, generation = versions.current()
+
+    if not info or info.get( 'generation' ) is None:
+        return None, True
+
+    if generation is None:
+        return None, False
+
+    if info[ 'generation' ] != generation:
+        if info[ 'generation' ][ 1 ] > generation[ 1 ]:
+            return None, False
+
+        try:
+            days = versions.changes_since_generation( solr, info[ 'generation' ] )
+        except Exception, e:
+            print "unable to check the Solr index for changes: {}".format( e )
+            return None, False
+
+        if word_count_index_version.overlaps( info[ 'date_range' ], days ):
+            if days is None or info.get( 'term_counts' ) is None:
+                return None, True
+
+            # older than any local version, so it is refreshed on its next request
+            return dict( info, version=-1 ), False
+
+    return dict( info, version=version ), False
+
+def preload_cache( num_entries=None ):
+    # Loads the hottest results from the disk cache into memory; returns the
+    # number loaded
+    if num_entries is None:
+        num_entries = int( mc_config.word_count_config().get( 'disk_cache_preload_entries' ) or 0 )
+
+    if not disk_cache.enabled or num_entries <= 0:
+        return 0
+
+    # results are checked against the current index
+    apply_cache_clears()
+    apply_index_changes()
+
+    loaded = 0
+    for key in disk_cache.hottest( num_entries ):
+        if load_from_disk( key, touch=False ) is not None:
+            loaded += 1
+
+    print "preloaded {} word count results from '{}'".format( loaded, disk_cache.path )
+
+    return loaded
+
+cache = word_count_cache.WordCountCache()
+
+disk_cache = word_count_disk_cache.DiskCache()
+
+single_flight = word_count_single_flight.SingleFlight()
+
+# The disk cache's clear generation when this worker last dropped (or first
+# checked) its in-memory caches
+seen_clear_generation = None
+
+# The gunicorn master's process ID in a production worker
+master_pid = None
+
+def _admission_controller():
+    config = mc_config.word_count_config()
+
+    max_concurrent_batch = config.get( 'max_concurrent_batch_requests' )
+
+    return word_count_admission.AdmissionController(
+        max_concurrent=int( config.get( 'max_concurrent_requests' ) or 0 ),
+        max_queued=int( config.get( 'max_queued_requests' ) or 0 ),
+        max_queue_seconds=float( config.get( 'max_queue_seconds' ) or 0 ),
+        max_concurrent_batch=int( max_concurrent_batch ) if max_concurrent_batch else None )
+
+admission = _admission_controller()
+
+def request_timeout( timeout ):
+    # Seconds a request may take: the client's timeout, capped at the
+    # configured request_timeout (0 means no limit)
+    max_timeout = float( mc_config.word_count_config().get( 'request_timeout' ) or 0 ) or None
+
+    try:
+        timeout = float( timeout ) if timeout else None
+    except ValueError:
+        timeout = None
+
+    if timeout is None or timeout <= 0:
+        return max_timeout
+    if max_timeout is None:
+        return timeout
+
+    return min( timeout, max_timeout )
+
+def error_response( status_code, message ):
+    ret = jsonify( { 'error': message } )
+    ret.status_code = status_code
+
+    return ret
+
+def apply_index_changes():
+    # Invalidates the cached results (and per-day counts) that sentences
+    # indexed since the last check could have changed
+    try:
+        change = word_count_index_version.index_versions().check( solr )
+    except Exception, e:
+        print "unable to check the Solr index version: {}".format( e )
+        return
+
+    if change is None:
+        return
+
+    version, days = change
+    if days is not None and not days:
+        return
+
+    # results that kept their term counts are refreshed on their next request
+    # instead, unless sentences were deleted
+    invalidated = cache.invalidate( lambda key, info: info is None or (
+            word_count_index_version.overlaps( info[ 'date_range' ], days ) and ( days is None or info.get( 'term_counts' ) is None ) ) )
+    invalidated_days = word_count_days.day_cache().invalidate( lambda key, info: info is None or days is None or info[ 'day' ] in days )
+
+    print "index version {}: invalidated {} results and {} days".format( version, invalidated, invalidated_days )
+
+def apply_cache_clears():
+    # Drops the in-memory caches if another worker cleared the disk cache
+    # since this one last looked
+    global seen_clear_generation
+
+    generation = disk_cache.clear_generation()
+    if generation is None or generation == seen_clear_generation:
+        return
+
+    # a worker's first look only tells it where things stand
+    if seen_clear_generation is not None:
+        print "disk cache cleared by another worker, clearing this worker's caches"
+        cache.clear()
+        word_count_days.day_cache().clear()
+
+    seen_clear_generation = generation
+
+def get_key( q, fq, engine=None, sample=None ):
+    return word_count_cache.make_key( q, fq, engine, sample )
 
 @app.route('/clear_cache')
 def clear_cache():
+    global seen_clear_generation
+
     print "Clearing cache"
     cache.clear()
+    disk_cache.clear()
+    word_count_days.day_cache().clear()
+
+    # the other workers notice the disk cache's new clear generation; without
+    # one they have to be replaced
+    generation = disk_cache.clear_generation()
+    if generation is not None:
+        seen_clear_generation = generation
+    elif master_pid is not None:
+        print "no disk cache to tell the other workers, replacing them"
+        os.kill( master_pid, signal.SIGHUP )
+
     return "Cache cleared\n"
 
+@app.route('/cache_stats')
+def cache_stats():
+    # of this worker only
+    stats = cache.stats()
+    stats[ 'worker' ] = os.getpid()
+    stats[ 'disk' ] = disk_cache.stats()
+    stats[ 'days' ] = word_count_days.day_cache().stats()
+    stats[ 'single_flight' ] = single_flight.stats()
+    stats[ 'admission' ] = admission.stats()
+    stats[ 'index' ] = word_count_index_version.index_versions().stats()
+
+    return jsonify( stats )
+
+@app.route('/metrics')
+def metrics():
+    result_cache_stats = cache.stats()
+    day_cache_stats = word_count_days.day_cache().stats()
+    disk_cache_stats = disk_cache.stats()
+    single_flight_stats = single_flight.stats()
+    admission_stats = admission.stats()
+    endpoint_stats = mc_solr.endpoint_stats()
+
+    def cache_samples( name ):
+        return [ ( { 'cache': 'results' }, result_cache_stats[ name ] ), ( { 'cache': 'days' }, day_cache_stats[ name ] ) ]
+
+    extra_metrics = [
+        ( 'word_count_cache_hits_total', 'counter', 'Word count cache hits', cache_samples( 'hits' ) ),
+        ( 'word_count_cache_misses_total', 'counter', 'Word count cache misses', cache_samples( 'misses' ) ),
+        ( 'word_count_cache_evictions_total', 'counter', 'Word count cache evictions', cache_samples( 'evictions' ) ),
+        ( 'word_count_cache_invalidations_total', 'counter', 'Word count cache entries invalidated by index changes', cache_samples( 'invalidations' ) ),
+        ( 'word_count_cache_entries', 'gauge', 'Entries in the word count caches', cache_samples( 'entries' ) ),
+        ( 'word_count_cache_bytes', 'gauge', 'Estimated size of the word count caches', cache_samples( 'bytes' ) ),
+        ( 'word_count_disk_cache_hits_total', 'counter', 'Word count disk cache hits', [ ( {}, disk_cache_stats[ 'hits' ] ) ] ),
+        ( 'word_count_disk_cache_misses_total', 'counter', 'Word count disk cache misses', [ ( {}, disk_cache_stats[ 'misses' ] ) ] ),
+        ( 'word_count_disk_cache_evictions_total', 'counter', 'Word count disk cache evictions', [ ( {}, disk_cache_stats[ 'evictions' ] ) ] ),
+        ( 'word_count_disk_cache_errors_total', 'counter', 'Failed word count disk cache operations', [ ( {}, disk_cache_stats[ 'errors' ] ) ] ),
+        ( 'word_count_disk_cache_entries', 'gauge', 'Entries in the word count disk cache', [ ( {}, disk_cache_stats[ 'entries' ] ) ] ),
+        ( 'word_count_disk_cache_bytes', 'gauge', 'Size of the word count disk cache entries', [ ( {}, disk_cache_stats[ 'bytes' ] ) ] ),
+        ( 'word_count_coalesced_requests_total', 'counter', 'Requests that waited for an identical in-flight request',
+          [ ( {}, single_flight_stats[ 'coalesced' ] ) ] ),
+        ( 'word_count_running_requests', 'gauge', 'Word count computations running, by priority class',
+          [ ( { 'priority': priority }, running ) for priority, running in sorted( admission_stats[ 'running' ].items() ) ] ),
+        ( 'word_count_waiting_requests', 'gauge', 'Word count computations waiting for a slot', [ ( {}, admission_stats[ 'waiting' ] ) ] ),
+        ( 'word_count_rejected_requests_total', 'counter', 'Word count requests rejected by admission control',
+          [ ( { 'reason': 'queue_full' }, admission_stats[ 'rejected' ] ), ( { 'reason': 'queue_timeout' }, admission_stats[ 'timed_out' ] ) ] ),
+        ]
+
+    def endpoint_samples( name ):
+        return [ ( { 'endpoint': endpoint[ 'url' ] }, endpoint[ name ] ) for endpoint in endpoint_stats if endpoint[ name ] is not None ]
+
+    extra_metrics += [
+        ( 'solr_endpoint_requests_total', 'counter', 'Requests sent to each Solr URL', endpoint_samples( 'requests' ) ),
+        ( 'solr_endpoint_failures_total', 'counter', 'Failed requests to each Solr URL', endpoint_samples( 'failures' ) ),
+        ( 'solr_endpoint_outstanding_requests', 'gauge', 'Requests in flight to each Solr URL', endpoint_samples( 'outstanding' ) ),
+        ( 'solr_endpoint_latency_seconds', 'gauge', 'Moving average latency of each Solr URL', endpoint_samples( 'latency' ) ),
+        ( 'solr_endpoint_ejected', 'gauge', 'Whether each Solr URL is out of rotation',
+          [ ( { 'endpoint': endpoint[ 'url' ] }, int( endpoint[ 'ejected' ] ) ) for endpoint in endpoint_stats ] ),
+        ]
+
+    return Response( word_count_metrics.render( extra_metrics, labels={ 'worker': os.getpid() } ), mimetype='text/plain; version=0.0.4' )
+
+@app.route('/health')
+def health():
+    status = word_count_pool.health_check()
+    status[ 'solr_endpoints' ] = mc_solr.endpoint_stats()
+    status[ 'worker' ] = os.getpid()
+
+    ret = jsonify( status )
+    if not status['healthy']:
+        ret.status_code = 503
+
+    return ret
+
 @app.route('/')
 def index():
     return "Hello, World!"
 
+def _server_workers():
+    workers = int( mc_config.word_count_config().get( 'server_workers' ) or 0 )
+    if workers <= 0:
+        workers = multiprocessing.cpu_count()
+
+    return workers
+
+def _worker_pool_size( workers ):
+    # An explicit pool_size is per serving worker; by default the CPUs are
+    # shared out between the serving workers
+    pool_size = int( mc_config.word_count_config().get( 'pool_size' ) or 0 )
+    if pool_size <= 0:
+        pool_size = max( multiprocessing.cpu_count() / workers, 1 )
+
+    return pool_size
+
+def serve_production( bind=None, workers=None, threads=None ):
+    # Imported here so that the development server doesn't need gunicorn
+    import gunicorn.app.base
+
+    config = mc_config.word_count_config()
+
+    if bind is None:
+        bind = config.get( 'server_bind' ) or '127.0.0.1:5000'
+    if workers is None:
+        workers = _server_workers()
+    if threads is None:
+        threads = int( config.get( 'server_threads' ) or 8 )
+
+    pool_size = _worker_pool_size( workers )
+
+    def post_fork( server, worker ):
+        global master_pid
+        master_pid = server.pid
+
+        word_count_pool.start( pool_size=pool_size )
+
+        # before the worker accepts its first request
+        preload_cache()
+
+    def worker_exit( server, worker ):
+        word_count_pool.stop()
+
+    options = {
+        'bind': bind,
+        'workers': workers,
+        'worker_class': 'gthread',
+        'threads': threads,
+        'preload_app': True,
+        # in-flight requests may run until their deadline on shutdown and reload
+        'graceful_timeout': int( config.get( 'request_timeout' ) or 0 ) or 600,
+        'post_fork': post_fork,
+        'worker_exit': worker_exit,
+        'proc_name': 'word_count_rest_server',
+        }
+
+    class Server( gunicorn.app.base.BaseApplication ):
+
+        def load_config( self ):
+            for name, value in options.iteritems():
+                self.cfg.set( name, value )
+
+        def load( self ):
+            return app
+
+    print "serving on {} with {} workers of {} threads (word count pool size {} per worker)".format( bind, workers, threads, pool_size )
+    box_limit = lambda limit: limit * workers if limit else 'unlimited'
+    print "admission limits per worker: {} running and {} queued computations ({} and {} for all workers)".format(
+        admission.max_concurrent or 'unlimited', admission.max_queued or 'unlimited', box_limit( admission.max_concurrent ), box_limit( admission.max_queued ) )
+
+    Server().run()
+
+def main():
+    parser = argparse.ArgumentParser( description='Word count service' )
+    parser.add_argument( '--production', action='store_true', help='serve with preforked gunicorn workers' )
+    parser.add_argument( '--bind', help='address to listen on (default: word_count.server_bind)' )
+    parser.add_argument( '--workers', type=int, help='serving workers (default: word_count.server_workers)' )
+    parser.add_argument( '--threads', type=int, help='threads per serving worker (default: word_count.server_threads)' )
+    args = parser.parse_args()
+
+    # loaded before any fork so that workers share it
+    word_count_stemmer.load_stem_dictionary()
+
+    if args.production:
+        serve_production( args.bind, args.workers, args.threads )
+        return
+
+    # fork the workers once, before any request threads exist
+    word_count_pool.start()
+
+    preload_cache()
+
+    app.run(debug = False, threaded = True )
+
 if __name__ == '__main__':
-    app.run(debug = False )
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+
+#
+# In-flight deduplication of identical word count requests
+#
+# The first request for a key runs the computation; identical requests that
+# arrive while it is running wait for its result (or its exception) instead of
+# running the same Solr fetch and count again.
+#
+# A waiting request gives up at its own deadline (word_count_deadline.py), and
+# takes over the computation if the one it waited for ran out of time first.
+#
+
+import sys
+import threading
+
+import word_count_deadline
+
+class _Call( object ):
+
+    def __init__( self ):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+class SingleFlight( object ):
+
+    def __init__( self ):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+        self.executed = 0
+        self.coalesced = 0
+
+    def do( self, key, function ):
+        with self._lock:
+            call = self._calls.get( key )
+
+            if call is None:
+                call = self._calls[ key ] = _Call()
+                leader = True
+                self.executed += 1
+            else:
+                leader = False
+                self.coalesced += 1
+
+        if not leader:
+            if not call.done.wait( word_count_deadline.remaining() ):
+                raise word_count_deadline.DeadlineExceeded( 'request deadline exceeded' )
+
+            if call.exc_info is not None:
+                if isinstance( call.exc_info[ 1 ], word_count_deadline.DeadlineExceeded ):
+                    return self.do( key, function )
+
+                raise call.exc_info[ 0 ], call.exc_info[ 1 ], call.exc_info[ 2 ]
+
+            return call.result
+
+        try:
+            call.result = function()
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[ key ]
+
+            call.done.set()
+
+        return call.result
+
+    def stats( self ):
+        with self._lock:
+            return {
+                'in_flight': len( self._calls ),
+                'executed': self.executed,
+                'coalesced': self.coalesced,
+                }
@@ -0,0 +1,151 @@
+#!/usr/bin/python
+
+#
+# Stemming layer for word counts
+#
+# A single Porter stemmer is shared by every request and term -> stem results are
+# memoized across requests.  The memo is bounded: it is split into two
+# generations and once the current generation reaches half of stem_memo_size the
+# older generation is dropped, so recently used terms survive while the memo
+# never holds more than stem_memo_size entries.
+#
+# A precomputed stem dictionary (one "term<TAB>stem" pair per line, as written by
+# save_stem_dictionary()) can be loaded at startup; its entries are never evicted.
+#
+
+import codecs
+import collections
+import os
+
+from nltk.stem.porter import PorterStemmer
+
+import mc_config
+
+_stemmer = PorterStemmer()
+
+_stem_dictionary = {}
+_memo = {}
+_previous_memo = {}
+
+def _memo_generation_size():
+    return max( int( mc_config.word_count_config().get( 'stem_memo_size' ) or 0 ) / 2, 1 )
+
+def stem_word( term ):
+    stem = _stem_dictionary.get( term )
+    if stem is not None:
+        return stem
+
+    stem = _memo.get( term )
+    if stem is not None:
+        return stem
+
+    stem = _previous_memo.get( term )
+    if stem is None:
+        stem = _stemmer.stem_word( term )
+
+    _remember( term, stem )
+
+    return stem
+
+def _remember( term, stem ):
+    global _memo, _previous_memo
+
+    if len( _memo ) >= _memo_generation_size():
+        _previous_memo = _memo
+        _memo = {}
+
+    _memo[ term ] = stem
+
+def clear_memo():
+    # Forgets memoized stems (but not the stem dictionary)
+    global _memo, _previous_memo
+
+    _memo = {}
+    _previous_memo = {}
+
+def stem_term_counts( term_counts ):
+    # Stems every distinct term once and returns a ( stem_counts, stem_to_terms,
+    # best_terms ) tuple, where best_terms maps each stem to its most frequent
+    # term (the first one seen on ties)
+    stem_counts = collections.Counter()
+    stem_to_terms = {}
+    best_terms = {}
+    best_term_counts = {}
+
+    for term, count in term_counts.iteritems():
+        stem = stem_word( term )
+
+        stem_counts[ stem ] += count
+
+        if stem not in stem_to_terms:
+            stem_to_terms[ stem ] = [ term ]
+            best_terms[ stem ] = term
+            best_term_counts[ stem ] = count
+        else:
+            stem_to_terms[ stem ].append( term )
+            if count > best_term_counts[ stem ]:
+                best_terms[ stem ] = term
+                best_term_counts[ stem ] = count
+
+    return stem_counts, stem_to_terms, best_terms
+
+def top_stemmed_counts( term_counts, num_words ):
+    # Returns the num_words most common stems as a list of { stem, term, count }
+    # dicts, where term is the most frequent surface form of the stem
+    stem_counts, stem_to_terms, best_terms = stem_term_counts( term_counts )
+
+    ret = []
+    for stem, count in stem_counts.most_common( num_words ):
+        ret.append(
+            { 'stem': stem,
+              'term': best_terms[ stem ],
+              'count': count
+              } )
+
+    return ret
+
+def load_stem_dictionary( path=None ):
+    # Loads the precomputed stem dictionary configured as stem_dictionary_path
+    # (or path); returns the number of entries loaded
+    global _stem_dictionary
+
+    if path is None:
+        path = mc_config.word_count_config().get( 'stem_dictionary_path' )
+
+    if not path:
+        return 0
+
+    if not os.path.isfile( path ):
+        print "stem dictionary '{}' does not exist, skipping".format( path )
+        return 0
+
+    stem_dictionary = {}
+    with codecs.open( path, 'r', 'utf-8' ) as f:
+        for line in f:
+            line = line.rstrip( u'\n' )
+            if not line:
+                continue
+
+            term, stem = line.split( u'\t', 1 )
+            stem_dictionary[ term ] = stem
+
+    _stem_dictionary = stem_dictionary
+
+    print "loaded {} stems from '{}'".format( len( stem_dictionary ), path )
+
+    return len( stem_dictionary )
+
+def save_stem_dictionary( path, terms=None ):
+    # Writes a stem dictionary for terms (by default every term stemmed so far)
+    if terms is None:
+        stems = dict( _stem_dictionary )
+        stems.update( _previous_memo )
+        stems.update( _memo )
+    else:
+        stems = dict( ( term, stem_word( term ) ) for term in terms )
+
+    with codecs.open( path, 'w', 'utf-8' ) as f:
+        for term in sorted( stems.keys() ):
+            f.write( u'{}\t{}\n'.format( term, stems[ term ] ) )
+
+    return len( stems )
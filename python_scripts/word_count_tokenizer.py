@@ -0,0 +1,58 @@
+#!/usr/bin/python
+
+#
+# Batch tokenizer and counter for pages of sentences
+#
+# Instead of one regex call (and one token list) per sentence, a whole page is
+# lowercased and split in a single pass over one buffer; the resulting term
+# counts are exactly those of tokenizing every sentence on its own with the
+# same regex.
+#
+# count_page() counts the tokens with a Counter.  count_tokens(), for callers
+# that want the distinct terms and a counts array (word_count_vocabulary.py),
+# hashes the tokens to integers and counts them with NumPy, checking that
+# every token equals the first token with its hash rather than building a set
+# of the tokens.
+#
+
+import collections
+import itertools
+import re
+
+import numpy as np
+
+# same split as solr_in_memory_wordcount_stemmed.tokenize()
+_token_split_re = re.compile( r'[\W\']+' )
+
+def tokenize_batch( sentences ):
+    # Sentences are joined with a space, which is itself a separator, so tokens
+    # of adjacent sentences are never glued together; the only difference from
+    # splitting each sentence on its own is the number of '' tokens
+    return _token_split_re.split( u' '.join( sentences ).lower() )
+
+def count_tokens( tokens ):
+    # Returns ( terms, counts ): the distinct tokens and a NumPy array holding
+    # the number of times each of them occurs
+    if not tokens:
+        return [], np.zeros( 0, dtype=np.int64 )
+
+    hashes = np.fromiter( itertools.imap( hash, tokens ), dtype=np.int64, count=len( tokens ) )
+
+    unique_hashes, first_index, token_ids = np.unique( hashes, return_index=True, return_inverse=True )
+
+    token_array = np.array( tokens, dtype=object )
+    terms = token_array[ first_index ]
+
+    if not ( terms[ token_ids ] == token_array ).all():
+        # two distinct tokens share a hash; count the strings themselves to stay exact
+        terms, token_ids = np.unique( token_array, return_inverse=True )
+
+    return terms.tolist(), np.bincount( token_ids )
+
+def count_page( sentences ):
+    # Term counts of a page of sentences, as a Counter without the '' token
+    freq = collections.Counter( tokenize_batch( sentences ) )
+
+    del freq['']
+
+    return freq
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+#
+# Bounded-memory heavy hitters summary for top-N word counts
+#
+# TopKSummary is a mergeable SpaceSaving-style summary holding at most capacity
+# terms.  Every retained term has an overestimated count and an error bound
+# (count - error <= true count <= count); a term that isn't retained occurred at
+# most min_count times.  While the vocabulary fits within capacity nothing is
+# ever dropped, min_count stays 0 and all counts are exact.
+#
+# Summaries of different pages merge into a summary with the same guarantees,
+# so pool workers send back summaries of at most capacity terms instead of full
+# counters.
+#
+
+import heapq
+import operator
+
+class TopKSummary( object ):
+
+    def __init__( self, capacity, counts=None, errors=None, min_count=0 ):
+        self.capacity = capacity
+        self.counts = counts if counts is not None else {}
+        # term -> error bound; terms without an entry are exact
+        self.errors = errors if errors is not None else {}
+        self.min_count = min_count
+
+    @classmethod
+    def from_counter( cls, counter, capacity ):
+        summary = cls( capacity )
+
+        if len( counter ) <= capacity:
+            summary.counts = dict( counter )
+        else:
+            summary.counts, summary.min_count = _truncate( counter, capacity )
+
+        return summary
+
+    def __len__( self ):
+        return len( self.counts )
+
+    def iteritems( self ):
+        return self.counts.iteritems()
+
+    def is_exact( self ):
+        return self.min_count == 0
+
+    def error( self, term ):
+        if term in self.counts:
+            return self.errors.get( term, 0 )
+
+        return self.min_count
+
+    def update( self, other ):
+        # Merges other into this summary in place
+        counts = {}
+        errors = {}
+
+        for term in set( self.counts ) | set( other.counts ):
+            counts[ term ] = self.counts.get( term, self.min_count ) + other.counts.get( term, other.min_count )
+
+            error = self.error( term ) + other.error( term )
+            if error:
+                errors[ term ] = error
+
+        min_count = self.min_count + other.min_count
+
+        if len( counts ) > self.capacity:
+            counts, dropped_count = _truncate( counts, self.capacity )
+            errors = dict( ( term, error ) for term, error in errors.iteritems() if term in counts )
+            min_count = max( min_count, dropped_count )
+
+        self.counts = counts
+        self.errors = errors
+        self.min_count = min_count
+
+    def most_common( self, n=None ):
+        if n is None:
+            return sorted( self.counts.iteritems(), key=operator.itemgetter( 1 ), reverse=True )
+
+        return heapq.nlargest( n, self.counts.iteritems(), key=operator.itemgetter( 1 ) )
+
+def _truncate( counts, capacity ):
+    # Returns the capacity largest counts and the largest count that was dropped
+    largest = heapq.nlargest( capacity + 1, counts.iteritems(), key=operator.itemgetter( 1 ) )
+
+    return dict( largest[ :capacity ] ), largest[ capacity ][ 1 ]
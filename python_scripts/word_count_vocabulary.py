@@ -0,0 +1,200 @@
+#!/usr/bin/python
+
+#
+# Interned vocabulary and array-backed term counts for pool workers
+#
+# Every pool worker interns the terms it sees for a request into a local
+# vocabulary table and sends back, per page, only the terms that are new to
+# that table plus two integer arrays: the local term IDs of the page and their
+# counts.  The parent maps local IDs to IDs in its own vocabulary and adds the
+# page counts to a single NumPy counts array, so term strings cross the process
+# boundary once per worker instead of once per page and merging is a vectorized
+# add instead of a Counter update.
+#
+# When a request is done the parent calls release(); the IDs of recently
+# released requests ride along with every later count_page() task, and the
+# worker that runs it drops their tables.  Workers also keep at most
+# max_worker_tables tables of at most max_worker_table_bytes (estimated) in
+# all, dropping the least recently used ones first.  If a table is dropped
+# while its request is still running the worker starts a new table (with a
+# new token) and the parent treats it as a new source.
+#
+
+import collections
+import itertools
+import sys
+import threading
+import uuid
+
+import numpy as np
+
+import word_count_deadline
+import word_count_tokenizer
+
+max_worker_tables = 8
+max_worker_table_bytes = 128 * 1024 * 1024
+
+# estimated bytes per interned term on top of the term string: its dict entry,
+# list slot and ID
+_term_overhead = 80
+
+# released request IDs sent along with each task
+max_released_requests = 64
+
+class _WorkerTable( object ):
+
+    def __init__( self ):
+        self.token = uuid.uuid4().hex
+        self.term_ids = {}
+        self.terms = []
+        self.sent = 0
+        self.size = 0
+
+    def intern( self, term ):
+        term_id = self.term_ids.get( term )
+        if term_id is None:
+            term_id = len( self.terms )
+            self.term_ids[ term ] = term_id
+            self.terms.append( term )
+            self.size += sys.getsizeof( term ) + _term_overhead
+
+        return term_id
+
+# request ID -> _WorkerTable, in the worker process
+_worker_tables = collections.OrderedDict()
+
+def _worker_table( request_id ):
+    table = _worker_tables.pop( request_id, None )
+    if table is None:
+        table = _WorkerTable()
+
+    _worker_tables[ request_id ] = table
+
+    return table
+
+def _drop_worker_tables( released ):
+    for request_id in released:
+        _worker_tables.pop( request_id, None )
+
+    # never drops the table of the page being counted, which is the most
+    # recently used one
+    while len( _worker_tables ) > 1 and (
+            len( _worker_tables ) > max_worker_tables or
+            sum( table.size for table in _worker_tables.itervalues() ) > max_worker_table_bytes ):
+        _worker_tables.popitem( last=False )
+
+# recently released request IDs, in the parent process
+_released = collections.deque( maxlen=max_released_requests )
+_released_lock = threading.Lock()
+
+def release( request_id ):
+    # Lets the workers drop the table of a request that is done
+    with _released_lock:
+        _released.append( request_id )
+
+def released_requests():
+    with _released_lock:
+        return tuple( _released )
+
+def count_page( request_id, sentences, deadline=None, released=() ):
+    # Pool task: tokenizes and counts a page of sentences.  Returns a
+    # ( table token, first new term ID, new terms, term IDs, counts ) tuple,
+    # or None without counting anything once the request's deadline passed.
+    # The tables of the released request IDs are dropped first.
+    _drop_worker_tables( released )
+
+    if word_count_deadline.expired( deadline ):
+        return None
+
+    terms, counts = word_count_tokenizer.count_tokens( word_count_tokenizer.tokenize_batch( sentences ) )
+
+    table = _worker_table( request_id )
+
+    term_ids = np.fromiter( itertools.imap( table.intern, terms ), dtype=np.int32, count=len( terms ) )
+
+    if u'' in table.term_ids:
+        keep = term_ids != table.term_ids[ u'' ]
+        term_ids = term_ids[ keep ]
+        counts = counts[ keep ]
+
+    first_new_id = table.sent
+    new_terms = table.terms[ first_new_id: ]
+    table.sent = len( table.terms )
+
+    _drop_worker_tables( () )
+
+    return table.token, first_new_id, new_terms, term_ids, counts.astype( np.int32 )
+
+class _GrowableArray( object ):
+    # NumPy array with amortized O(1) appends
+
+    def __init__( self, dtype ):
+        self._data = np.zeros( 1024, dtype=dtype )
+        self._size = 0
+
+    def __len__( self ):
+        return self._size
+
+    def resize( self, size ):
+        if size > len( self._data ):
+            data = np.zeros( max( size, 2 * len( self._data ) ), dtype=self._data.dtype )
+            data[ :self._size ] = self._data[ :self._size ]
+            self._data = data
+
+        self._size = size
+
+    def extend( self, values ):
+        start = self._size
+        self.resize( start + len( values ) )
+        self._data[ start:self._size ] = values
+
+    def view( self ):
+        return self._data[ :self._size ]
+
+class InternedCounts( object ):
+    # Parent side: the vocabulary of one request and its term counts
+
+    def __init__( self ):
+        self.terms = []
+        self.term_ids = {}
+        self.counts = _GrowableArray( np.int64 )
+
+        # worker table token -> array mapping the table's term IDs to ours
+        self._mappings = {}
+
+    def _intern( self, term ):
+        term_id = self.term_ids.get( term )
+        if term_id is None:
+            term_id = len( self.terms )
+            self.term_ids[ term ] = term_id
+            self.terms.append( term )
+
+        return term_id
+
+    def add( self, page_counts ):
+        # Merges the result of a count_page() task; results from any one worker
+        # table must be added in the order the tasks were submitted
+        token, first_new_id, new_terms, term_ids, counts = page_counts
+
+        mapping = self._mappings.get( token )
+        if mapping is None:
+            mapping = self._mappings[ token ] = _GrowableArray( np.int64 )
+
+        if first_new_id != len( mapping ):
+            raise Exception( "expected terms of worker table {} from ID {}, got them from ID {}".format( token, len( mapping ), first_new_id ) )
+
+        mapping.extend( [ self._intern( term ) for term in new_terms ] )
+
+        self.counts.resize( len( self.terms ) )
+
+        # term IDs are unique within a page, so a fancy-indexed add is safe
+        self.counts.view()[ mapping.view()[ term_ids ] ] += counts
+
+    def __len__( self ):
+        return len( self.terms )
+
+    def to_counter( self ):
+        counts = self.counts.view()
+        nonzero = np.flatnonzero( counts )
+
+        return collections.Counter( dict( itertools.izip( [ self.terms[ i ] for i in nonzero ], counts[ nonzero ].tolist() ) ) )